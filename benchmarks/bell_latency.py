@@ -0,0 +1,194 @@
+#!/usr/bin/env python2
+
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+""" Measure a bell end to end, from the UDP packet to the restored music.
+
+  A LextendEngine is started in this process, with its pool pinned to fake
+  speakers (see fake_sonos.py) instead of the discovered ones. For each pool
+  size, bells are rung with UDP packets and the phases recorded by
+  SonosPoolManager.bell_timings are reported :
+    snapshot : pause and save the state of the zones.
+    regroup  : join the zones to one group, set the bell volume.
+    play     : regrouped to the first sound started.
+    press    : UDP packet sent to the bell heard on the fake speaker.
+    end      : bell ended on the speaker to its end detected by lextend.
+    restore  : ungroup and resume the zones.
+    total    : UDP packet sent to the music restored.
+
+  The engine gets its configuration, sounds and log file in a temporary
+  folder, removed at the end unless --keep is given.
+
+  Run it with the engine stopped (UDP port, RPC):
+    benchmarks/bell_latency.py --sizes 1,2,4,8,16,32 -n 10 --latency 20
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from fake_sonos import FakeHouse, local_ips, add_house_arguments
+from sound_ttfb import percentile
+
+import run_lextend_engine
+from utils.settings import UDP_PORT
+
+PHASES = [
+  ("snapshot", lambda t, bell, sent: t["paused"] - t["start"]),
+  ("regroup",  lambda t, bell, sent: t["regrouped"] - t["paused"]),
+  ("play",     lambda t, bell, sent: t["playing"] - t["regrouped"]),
+  ("press",    lambda t, bell, sent: bell["started"] - sent),
+  ("end",      lambda t, bell, sent: t["ended"] - bell["ended"]),
+  ("restore",  lambda t, bell, sent: t["restored"] - t["ended"]),
+  ("total",    lambda t, bell, sent: t["restored"] - sent),
+]
+
+def report(name, values):
+  if not values:
+    return
+  print "  %-8s n=%-4s min=%8.1fms p50=%8.1fms p95=%8.1fms p99=%8.1fms " \
+        "max=%8.1fms" % (name, len(values), min(values) * 1000,
+                         percentile(values, 50) * 1000,
+                         percentile(values, 95) * 1000,
+                         percentile(values, 99) * 1000, max(values) * 1000)
+
+def pin_pool(pool, speakers):
+  """ Replace the devices of the pool with the fake speakers.
+  """
+  # Let a discovery in progress finish, then keep the next ones away.
+  with pool.discover_lock:
+    pool.discover = lambda progress=None: None
+    devices = []
+    for sonos in speakers:
+      device = pool.create_device(sonos.ip)
+      device.zone_name = sonos.zone_name
+      devices.append(device)
+    pool.devices_list = devices
+
+def ring(engine, house, packet, timeout):
+  """ Ring one bell and wait until the music is restored.
+  Returns:
+    (bell_timings entry, fake bell, time the packet was sent), None on
+    timeout.
+  """
+  timings = engine.sonosPoolManager.bell_timings
+  last = timings[-1] if timings else None
+  first_bell = len(house.bells)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sent = time.time()
+  sock.sendto(packet, ("127.0.0.1", UDP_PORT))
+  sock.close()
+  while not timings or timings[-1] is last:
+    if time.time() - sent > timeout:
+      return None
+    time.sleep(0.01)
+  bells = house.bells[first_bell:]
+  if not bells or bells[0]["ended"] is None:
+    return None
+  return timings[-1], bells[0], sent
+
+def run(args, sizes, house, folder):
+  """ Start the engine in folder, and ring the bells.
+  """
+  # The default sounds are copied from the repository.
+  os.chdir(ROOT)
+  run_lextend_engine.setup_logging(os.path.join(folder, "lextend.engine.log"))
+  engine = run_lextend_engine.LextendEngine(config_subdir=folder)
+  thread = threading.Thread(target=engine.run)
+  thread.setDaemon(True)
+  thread.start()
+  try:
+    return ring_bells(args, sizes, house, engine)
+  finally:
+    # Stop watching the folder before it is removed.
+    for manager in (engine.cfg, engine.soundsManager):
+      notifier = getattr(manager, "notifier", None)
+      if notifier is not None:
+        notifier.stop()
+
+def ring_bells(args, sizes, house, engine):
+  """ Ring args.n bells per pool size, and report the phases.
+  """
+  bell = engine.bell_table[args.sound]
+  if bell is None:
+    print "No sound for protocol sound %s." % args.sound
+    return 1
+  house.bell_duration = args.bell_duration or bell[2] or 2.0
+  packet = engine.cfg.snapshot.protocol + "%s%s" % (args.sound, args.volume)
+  timeout = house.bell_duration + 120
+  print "Bell %s, %.2fs, latency %sms +/- %sms, failure rate %s." % (
+    bell[1], house.bell_duration, args.latency, args.jitter, args.failure_rate)
+
+  for size in sizes:
+    pin_pool(engine.sonosPoolManager, house.speakers[:size])
+    results = []
+    for i in range(args.n):
+      house.reset()
+      result = ring(engine, house, packet, timeout)
+      if result is None:
+        print "  bell %s timed out, or did not play." % (i + 1)
+      else:
+        results.append(result)
+      time.sleep(args.pause)
+
+    print "%s zone(s), %s/%s bell(s) :" % (size, len(results), args.n)
+    for name, phase in PHASES:
+      values = []
+      for result in results:
+        try:
+          values.append(phase(*result))
+        except (KeyError, TypeError):
+          # Phase not reached, e.g. the sound did not start.
+          pass
+      report(name, values)
+
+  return 0
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+  add_house_arguments(parser)
+  parser.add_argument("--sizes", default="1,2,4,8,16,32",
+                      help="pool sizes, comma separated")
+  parser.add_argument("-n", type=int, default=10, help="bells per pool size")
+  parser.add_argument("--sound", type=int, default=1,
+                      help="protocol sound, 1..9")
+  parser.add_argument("--volume", type=int, default=5,
+                      help="protocol volume, 1..9")
+  parser.add_argument("--bell-duration", type=float,
+                      help="seconds a bell plays, default the sound duration")
+  parser.add_argument("--pause", type=float, default=0.5,
+                      help="seconds between two bells")
+  parser.add_argument("--keep", action="store_true",
+                      help="keep the engine configuration and log folder")
+  args = parser.parse_args()
+
+  sizes = [int(size) for size in args.sizes.split(",")]
+  house = FakeHouse(local_ips(max(sizes), args.first_ip),
+                    args.latency / 1000.0, args.jitter / 1000.0,
+                    args.failure_rate)
+  house.start()
+
+  folder = tempfile.mkdtemp(prefix="lextend-bench-")
+  try:
+    return run(args, sizes, house, folder)
+  finally:
+    house.stop()
+    if args.keep:
+      print "Configuration and log kept in %s." % folder
+    else:
+      shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,464 @@
+#!/usr/bin/env python2
+
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+""" Simulated Sonos speakers, for the benchmarks.
+
+  Each FakeSonos answers the SOAP actions used by SoCo and lextend on
+  ip:1400, and sends AVTransport GENA events to its subscribers. The speakers
+  of a FakeHouse share one zone group topology. Every SOAP request is delayed
+  by latency +/- jitter, and fails with a UPnP error with failure_rate.
+
+  A sound that is not a queue or a group URI plays for bell_duration seconds,
+  the queue plays until stopped.
+
+  Usage, 4 speakers on 127.0.0.10 to 127.0.0.13 until Ctrl-C:
+    benchmarks/fake_sonos.py --zones 4 --latency 20 --jitter 5
+"""
+
+import re
+import time
+import uuid
+import random
+import socket
+import httplib
+import argparse
+import threading
+import urlparse
+from xml.sax.saxutils import escape
+from xml.etree import cElementTree as ElementTree
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+SOAP_ENVELOPE = ('<?xml version="1.0"?>'
+                 '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
+                 ' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                 '<s:Body>%s</s:Body></s:Envelope>')
+
+SOAP_FAULT = ('<s:Fault><faultcode>s:Client</faultcode>'
+              '<faultstring>UPnPError</faultstring><detail>'
+              '<UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+              '<errorCode>%s</errorCode></UPnPError></detail></s:Fault>')
+
+SOAP_ACTION_RE = re.compile(r'"?urn:schemas-upnp-org:service:(\w+):\d#(\w+)"?')
+
+class FakeSonos():
+  """ State of one simulated speaker.
+  """
+  def __init__(self, house, ip, index):
+    self.house = house
+    self.ip = ip
+    self.uid = "RINCON_FAKE%08d01400" % index
+    self.zone_name = "Zone %s" % index
+    self.coordinator = self         # FakeSonos of the group coordinator
+    self.volume = 20
+    self.transport_uri = "x-rincon-queue:%s#0" % self.uid
+    self.track = 1
+    self.track_uri = "x-file-cifs://nas/music/track%s.mp3" % self.track
+    self.state = "PLAYING"
+    self.position = 0               # seconds, at position_time
+    self.position_time = time.time()
+    self.bell_timer = None
+    self.subscriptions = {}         # sid => callback url
+    self.lock = threading.RLock()
+
+  # Transport ---------------------------------------------------------------
+
+  def rel_time(self):
+    position = self.position
+    if self.state == "PLAYING":
+      position += time.time() - self.position_time
+    position = int(position)
+    return "%d:%02d:%02d" % (position // 3600, position // 60 % 60,
+                             position % 60)
+
+  def set_state(self, state):
+    with self.lock:
+      if self.state == "PLAYING":
+        self.position += time.time() - self.position_time
+      self.position_time = time.time()
+      self.state = state
+      if state != "PLAYING" and self.bell_timer is not None:
+        self.bell_timer.cancel()
+        self.bell_timer = None
+    self.house.on_state(self, state)
+    self.notify()
+
+  def set_uri(self, uri):
+    with self.lock:
+      if uri.startswith("x-rincon:"):
+        self.join(self.house.by_uid[uri[len("x-rincon:"):]])
+        return
+      self.transport_uri = uri
+      self.track_uri = uri
+      if uri.startswith("x-rincon-queue:"):
+        self.track_uri = "x-file-cifs://nas/music/track%s.mp3" % self.track
+      self.position = 0
+      self.state = "STOPPED"
+
+  def play(self):
+    with self.lock:
+      bell = not self.transport_uri.startswith("x-rincon")
+      if bell:
+        if self.bell_timer is not None:
+          self.bell_timer.cancel()
+        self.bell_timer = threading.Timer(self.house.bell_duration,
+                                          self.set_state, ["STOPPED"])
+        self.bell_timer.setDaemon(True)
+        self.bell_timer.start()
+    if bell:
+      self.house.on_bell(self, self.track_uri)
+    self.set_state("PLAYING")
+
+  def join(self, master):
+    with self.lock:
+      if self.state == "PLAYING":
+        self.set_state("STOPPED")
+      self.coordinator = master.coordinator
+
+  def unjoin(self):
+    with self.lock:
+      self.coordinator = self
+      self.transport_uri = "x-rincon-queue:%s#0" % self.uid
+      self.state = "STOPPED"
+
+  def seek(self, unit, target):
+    with self.lock:
+      if unit == "TRACK_NR":
+        self.track = int(target)
+        self.track_uri = "x-file-cifs://nas/music/track%s.mp3" % self.track
+        self.position = 0
+      else:
+        h, m, sec = [int(x) for x in target.split(":")]
+        self.position = h * 3600 + m * 60 + sec
+      self.position_time = time.time()
+
+  # SOAP actions ------------------------------------------------------------
+
+  def call(self, service, action, args):
+    """ Run a SOAP action.
+    Returns:
+      [(name, value), ...] out arguments.
+    """
+    # Group members report the transport of their coordinator.
+    transport = self.coordinator
+    if service == "AVTransport":
+      if action == "GetTransportInfo":
+        return [("CurrentTransportState", transport.state),
+                ("CurrentTransportStatus", "OK"), ("CurrentSpeed", "1")]
+      if action == "GetPositionInfo":
+        return [("Track", str(transport.track)), ("TrackDuration", "0:04:00"),
+                ("TrackMetaData", ""), ("TrackURI", transport.track_uri),
+                ("RelTime", transport.rel_time()), ("AbsTime", "NOT_IMPLEMENTED"),
+                ("RelCount", "2147483647"), ("AbsCount", "2147483647")]
+      if action == "GetMediaInfo":
+        return [("NrTracks", "10"), ("MediaDuration", "NOT_IMPLEMENTED"),
+                ("CurrentURI", transport.transport_uri),
+                ("CurrentURIMetaData", ""), ("NextURI", ""),
+                ("NextURIMetaData", ""), ("PlayMedium", "NETWORK"),
+                ("RecordMedium", "NOT_IMPLEMENTED"),
+                ("WriteStatus", "NOT_IMPLEMENTED")]
+      if action == "SetAVTransportURI":
+        self.set_uri(args.get("CurrentURI", ""))
+        return []
+      if action == "Play":
+        self.play()
+        return []
+      if action == "Pause":
+        self.set_state("PAUSED_PLAYBACK")
+        return []
+      if action == "Stop":
+        self.set_state("STOPPED")
+        return []
+      if action == "Seek":
+        self.seek(args.get("Unit"), args.get("Target"))
+        return []
+      if action == "BecomeCoordinatorOfStandaloneGroup":
+        self.unjoin()
+        return []
+    elif service == "RenderingControl":
+      if action == "GetVolume":
+        return [("CurrentVolume", str(self.volume))]
+      if action in ("SetVolume", "RampToVolume"):
+        self.volume = int(args.get("DesiredVolume", self.volume))
+        return [("RampTime", "0")] if action == "RampToVolume" else []
+      if action == "GetMute":
+        return [("CurrentMute", "0")]
+    elif service == "ZoneGroupTopology":
+      if action == "GetZoneGroupState":
+        return [("ZoneGroupState", self.house.zone_group_state())]
+    elif service == "DeviceProperties":
+      if action == "GetZoneAttributes":
+        return [("CurrentZoneName", self.zone_name), ("CurrentIcon", ""),
+                ("CurrentConfiguration", "1")]
+      if action == "GetZoneInfo":
+        return [("SerialNumber", self.uid), ("SoftwareVersion", "fake"),
+                ("IPAddress", self.ip), ("MACAddress", "00:00:00:00:00:00")]
+    elif service == "ContentDirectory":
+      if action == "Browse":
+        return [("Result", ""), ("NumberReturned", "0"),
+                ("TotalMatches", "0"), ("UpdateID", "1")]
+    return []
+
+  # Events ------------------------------------------------------------------
+
+  def subscribe(self, callback):
+    sid = "uuid:%s" % uuid.uuid4()
+    self.subscriptions[sid] = callback
+    return sid
+
+  def unsubscribe(self, sid):
+    self.subscriptions.pop(sid, None)
+
+  def notify(self, sids=None):
+    """ Send the AVTransport state to the subscribers, in background.
+    """
+    with self.lock:
+      last_change = ('<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/">'
+                     '<InstanceID val="0">'
+                     '<TransportState val="%s"/>'
+                     '<CurrentTrackURI val="%s"/>'
+                     '<AVTransportURI val="%s"/>'
+                     '</InstanceID></Event>' %
+                     (self.state, escape(self.track_uri, {'"': "&quot;"}),
+                      escape(self.transport_uri, {'"': "&quot;"})))
+    body = ('<?xml version="1.0"?><e:propertyset '
+            'xmlns:e="urn:schemas-upnp-org:event-1-0"><e:property>'
+            '<LastChange>%s</LastChange></e:property></e:propertyset>' %
+            escape(last_change))
+    for sid, callback in list(self.subscriptions.items()):
+      if sids is None or sid in sids:
+        thread = threading.Thread(target=self.send_notify,
+                                  args=(sid, callback, body))
+        thread.setDaemon(True)
+        thread.start()
+
+  def send_notify(self, sid, callback, body):
+    parts = urlparse.urlsplit(callback)
+    try:
+      conn = httplib.HTTPConnection(parts.hostname, parts.port, timeout=5)
+      conn.request("NOTIFY", parts.path or "/", body,
+                   {"NT": "upnp:event", "NTS": "upnp:propchange", "SID": sid,
+                    "SEQ": "0", "Content-Type": 'text/xml; charset="utf-8"'})
+      conn.getresponse().read()
+      conn.close()
+    except (socket.error, httplib.HTTPException):
+      pass
+
+class FakeSonosHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def send(self, code, body="", headers=None):
+    self.send_response(code)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    length = int(self.headers.getheader("content-length") or 0)
+    data = self.rfile.read(length)
+    self.server.house.delay()
+
+    match = SOAP_ACTION_RE.match(self.headers.getheader("soapaction") or "")
+    if match is None:
+      self.send(400)
+      return
+    service, action = match.groups()
+    if self.server.house.fail():
+      self.send(500, SOAP_ENVELOPE % (SOAP_FAULT % 701),
+                {"Content-Type": 'text/xml; charset="utf-8"'})
+      return
+
+    args = {}
+    try:
+      body = ElementTree.fromstring(data).find(
+        "{http://schemas.xmlsoap.org/soap/envelope/}Body")
+      for arg in body[0]:
+        args[arg.tag.split("}")[-1]] = arg.text or ""
+    except (SyntaxError, IndexError, AttributeError):
+      pass
+
+    out = self.server.sonos.call(service, action, args)
+    response = '<u:%sResponse xmlns:u="urn:schemas-upnp-org:service:%s:1">' \
+               '%s</u:%sResponse>' % (action, service,
+               "".join("<%s>%s</%s>" % (name, escape(value), name)
+                       for name, value in out), action)
+    self.send(200, SOAP_ENVELOPE % response,
+              {"Content-Type": 'text/xml; charset="utf-8"'})
+
+  def do_GET(self):
+    self.server.house.delay()
+    sonos = self.server.sonos
+    if self.path.startswith("/status/zp"):
+      self.send(200, "<ZPSupportInfo><ZPInfo><ZoneName>%s</ZoneName>"
+                     "<ZoneIcon></ZoneIcon><LocalUID>%s</LocalUID>"
+                     "<SerialNumber>%s</SerialNumber>"
+                     "<SoftwareVersion>fake</SoftwareVersion>"
+                     "<HardwareVersion>fake</HardwareVersion>"
+                     "<MACAddress>00:00:00:00:00:00</MACAddress>"
+                     "</ZPInfo></ZPSupportInfo>" %
+                     (sonos.zone_name, sonos.uid, sonos.uid),
+                {"Content-Type": "text/xml"})
+      return
+    self.send(404)
+
+  def do_SUBSCRIBE(self):
+    sonos = self.server.sonos
+    sid = self.headers.getheader("sid")
+    if sid is None:
+      callback = (self.headers.getheader("callback") or "").strip("<>")
+      sid = sonos.subscribe(callback)
+    self.send(200, "", {"SID": sid, "TIMEOUT": "Second-300"})
+    # Initial event, as sent by the speakers.
+    sonos.notify([sid])
+
+  def do_UNSUBSCRIBE(self):
+    self.server.sonos.unsubscribe(self.headers.getheader("sid"))
+    self.send(200)
+
+  def log_message(self, format, *args):
+    pass
+
+class FakeSonosServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, house, sonos, port=1400):
+    self.house = house
+    self.sonos = sonos
+    HTTPServer.__init__(self, (sonos.ip, port), FakeSonosHandler)
+
+class FakeHouse():
+  """ A set of simulated speakers sharing a zone group topology.
+
+    Bells started and ended are recorded in self.bells, as dicts with the
+    speaker ip, uri, "started" and "ended" times.
+  """
+  def __init__(self, ips, latency=0.0, jitter=0.0, failure_rate=0.0,
+               bell_duration=2.0, port=1400):
+    """
+    Args:
+      ips ([str, ...]): local addresses of the speakers, e.g. 127.0.0.10.
+      latency (float): seconds added to each request.
+      jitter (float): standard deviation of the latency, in seconds.
+      failure_rate (float): probability of a SOAP request to fail.
+      bell_duration (float): seconds a bell sound plays.
+    """
+    self.latency = latency
+    self.jitter = jitter
+    self.failure_rate = failure_rate
+    self.bell_duration = bell_duration
+    self.port = port
+    self.speakers = [FakeSonos(self, ip, i + 1) for i, ip in enumerate(ips)]
+    self.by_uid = dict((s.uid, s) for s in self.speakers)
+    self.bells = []
+    self.lock = threading.Lock()
+    self.servers = []
+
+  def start(self):
+    for sonos in self.speakers:
+      server = FakeSonosServer(self, sonos, self.port)
+      thread = threading.Thread(target=server.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+      self.servers.append(server)
+
+  def stop(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+
+  def reset(self):
+    """ Ungroup the speakers and play their queue, as before a bell.
+    """
+    for sonos in self.speakers:
+      sonos.unjoin()
+      sonos.set_uri(sonos.transport_uri)
+      sonos.state = "PLAYING"
+      sonos.position_time = time.time()
+
+  def delay(self):
+    delay = random.gauss(self.latency, self.jitter) if self.jitter \
+            else self.latency
+    if delay > 0:
+      time.sleep(delay)
+
+  def fail(self):
+    return self.failure_rate and random.random() < self.failure_rate
+
+  def on_bell(self, sonos, uri):
+    with self.lock:
+      self.bells.append({"ip": sonos.ip, "uri": uri, "started": time.time(),
+                         "ended": None})
+
+  def on_state(self, sonos, state):
+    if state == "PLAYING":
+      return
+    with self.lock:
+      for bell in reversed(self.bells):
+        if bell["ip"] == sonos.ip:
+          if bell["ended"] is None:
+            bell["ended"] = time.time()
+          break
+
+  def zone_group_state(self):
+    groups = {}
+    for sonos in self.speakers:
+      groups.setdefault(sonos.coordinator.uid, []).append(sonos)
+    xml = "<ZoneGroups>"
+    for coordinator_uid in sorted(groups):
+      xml += '<ZoneGroup Coordinator="%s" ID="%s:1">' % (coordinator_uid,
+                                                          coordinator_uid)
+      for sonos in groups[coordinator_uid]:
+        xml += ('<ZoneGroupMember UUID="%s" '
+                'Location="http://%s:%s/xml/device_description.xml" '
+                'ZoneName="%s"/>' % (sonos.uid, sonos.ip, self.port,
+                                     sonos.zone_name))
+      xml += "</ZoneGroup>"
+    return xml + "</ZoneGroups>"
+
+def local_ips(count, first="127.0.0.10"):
+  """ Return count loopback addresses from first, Linux routes all 127/8.
+  """
+  base, last = first.rsplit(".", 1)
+  return ["%s.%s" % (base, int(last) + i) for i in range(count)]
+
+def add_house_arguments(parser):
+  """ Add the options of a FakeHouse to an argparse parser.
+  """
+  parser.add_argument("--first-ip", default="127.0.0.10",
+                      help="address of the first fake speaker")
+  parser.add_argument("--latency", type=float, default=0,
+                      help="ms added to each SOAP request")
+  parser.add_argument("--jitter", type=float, default=0,
+                      help="standard deviation of the latency, in ms")
+  parser.add_argument("--failure-rate", type=float, default=0,
+                      help="probability of a SOAP request to fail")
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+  add_house_arguments(parser)
+  parser.add_argument("--zones", type=int, default=4)
+  parser.add_argument("--bell-duration", type=float, default=2.0,
+                      help="seconds a bell sound plays")
+  args = parser.parse_args()
+
+  house = FakeHouse(local_ips(args.zones, args.first_ip),
+                    args.latency / 1000.0, args.jitter / 1000.0,
+                    args.failure_rate, args.bell_duration)
+  house.start()
+  print "Serving %s fake speakers from %s." % (args.zones, args.first_ip)
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    house.stop()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+""" Compare the time to first byte of a bell sound over HTTP and CIFS.
+
+  HTTP : the built-in sound server is started on the given folder, unless
+         --url points to a running one.
+  CIFS : the sound is read from a mounted sonos_share, e.g.
+         mount -t cifs //192.168.0.231/sonos_share /mnt/sonos_share
+         The page cache is dropped before each read when running as root.
+
+  Usage:
+    benchmarks/sound_ttfb.py --folder /root/.config/lextend/sounds \\
+        --sound defaults/1-Doorbell.mp3 --cifs /mnt/sonos_share
+"""
+
+import os
+import sys
+import socket
+import time
+import argparse
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.sound_server import SoundServer
+
+def percentile(values, p):
+  values = sorted(values)
+  index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+  return values[index]
+
+def report(name, values):
+  if not values:
+    return
+  print "%-5s n=%-4s min=%7.2fms p50=%7.2fms p95=%7.2fms max=%7.2fms" % (
+    name, len(values), min(values) * 1000, percentile(values, 50) * 1000,
+    percentile(values, 95) * 1000, max(values) * 1000)
+
+def http_ttfb(url):
+  """ Seconds from connect to the first byte of the body, new connection.
+  """
+  parts = urlparse.urlsplit(url)
+  start = time.time()
+  s = socket.create_connection((parts.hostname, parts.port or 80))
+  try:
+    s.sendall("GET %s HTTP/1.1\r\nHost: %s\r\nRange: bytes=0-\r\n"
+              "Connection: close\r\n\r\n" % (parts.path, parts.netloc))
+    data = ""
+    while "\r\n\r\n" not in data:
+      chunk = s.recv(4096)
+      if not chunk:
+        raise Exception("Connection closed before the body.")
+      data += chunk
+    if data.endswith("\r\n\r\n"):
+      s.recv(1)
+    return time.time() - start
+  finally:
+    s.close()
+
+def drop_caches():
+  try:
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+      f.write("3\n")
+  except IOError:
+    pass
+
+def cifs_ttfb(path):
+  """ Seconds to open the file and read its first byte.
+  """
+  drop_caches()
+  start = time.time()
+  with open(path, "rb") as f:
+    f.read(1)
+  return time.time() - start
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--folder", default="/root/.config/lextend/sounds",
+                      help="sounds folder served over HTTP")
+  parser.add_argument("--sound", default="defaults/1-Doorbell.mp3",
+                      help="sound path, relative to the sounds folder")
+  parser.add_argument("--url", help="base URL of a running sound server")
+  parser.add_argument("--port", type=int, default=18080)
+  parser.add_argument("--cifs", help="mount point of the sonos_share")
+  parser.add_argument("-n", type=int, default=50, help="requests per method")
+  args = parser.parse_args()
+
+  base = args.url
+  if base is None:
+    SoundServer(args.folder, args.port, "127.0.0.1").start()
+    base = "http://127.0.0.1:%s/" % args.port
+
+  report("HTTP", [http_ttfb(base + args.sound) for _ in range(args.n)])
+  if args.cifs:
+    path = os.path.join(args.cifs, args.sound)
+    report("CIFS", [cifs_ttfb(path) for _ in range(args.n)])
+
+if __name__ == "__main__":
+  main()
@@ -1,2 +1,3 @@
 from xmlsettings import XMLSettings
-from config_manager import ConfigManager
+from config_manager import ConfigManager, ConfigSnapshot
+from config_manager import parse_zones, format_zones
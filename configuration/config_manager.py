@@ -4,6 +4,8 @@
 # See the file COPYING for details.
 
 import os
+import tempfile
+import threading
 from xmlsettings import XMLSettings
 from lxml import etree
 
@@ -11,10 +13,99 @@ import pyinotify
 
 import logging
 
-import time
-
 class dummy: pass
 
+# Seconds without change to the config file before it is reloaded.
+RELOAD_DELAY = 0.2
+
+def parse_zones(text):
+  """ Parse the zone groups setting.
+
+    Format: "SUBDEV:zone,zone;SUBDEV:zone", e.g. "a:Kitchen,Hall;b:Garage".
+    Zones are Sonos zone names or IP addresses.
+  Returns:
+    {subdev: [zone, ...]}, invalid entries are skipped.
+  """
+  zones = {}
+  for entry in text.split(";"):
+    subdev, _, names = entry.partition(":")
+    subdev = subdev.strip()
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    if len(subdev) == 1 and names:
+      zones[subdev] = names
+  return zones
+
+def format_zones(zones):
+  """ Return the zone groups setting text, see parse_zones.
+  """
+  return ";".join("%s:%s" % (subdev, ",".join(zones[subdev]))
+                  for subdev in sorted(zones))
+
+class ConfigSnapshot(object):
+  """ Immutable copy of the settings used to handle a packet.
+
+    A new snapshot is built each time the settings are loaded or saved and
+    replaces the previous one with a single assignment, so a reader holding
+    a snapshot always sees a complete and consistent configuration.
+
+    Values derived from the settings are computed once here :
+      volumes[v] : volume to play at for protocol volume v (0..9).
+      sound_slots[s] : sound index to play for protocol sound s (0..9).
+      use_default[s] : True if the default sound of index s is used.
+      zones : ((subdev, (zone, ...)), ...) the zones each SubDev targets,
+              sorted by SubDev. See subdev_zones().
+  """
+  __slots__ = ("generation", "enable", "volume_override", "volume",
+               "default_sound", "sounds_filelist", "protocol", "zones",
+               "volumes", "sound_slots", "use_default")
+
+  def __init__(self, cfg, generation):
+    """
+    Args:
+      cfg (ConfigManager): a loaded configuration.
+      generation (int): ConfigManager.generation of cfg.
+    """
+    sonos_doorbell = cfg.sonos_doorbell
+    values = {
+      "generation": generation,
+      "enable": sonos_doorbell.enable,
+      "volume_override": sonos_doorbell.volume_override,
+      "volume": sonos_doorbell.volume,
+      "default_sound": sonos_doorbell.default_sound,
+      "sounds_filelist": tuple(sonos_doorbell.sounds_filelist),
+      "protocol": sonos_doorbell.protocol,
+      "zones": tuple((subdev, tuple(sonos_doorbell.zones[subdev]))
+                     for subdev in sorted(sonos_doorbell.zones)),
+    }
+    if sonos_doorbell.volume_override:
+      values["volumes"] = (sonos_doorbell.volume,) * 10
+    else:
+      values["volumes"] = tuple(v * 11 for v in range(10)) # [0,9] => [0-100]
+    if sonos_doorbell.default_sound != 0:
+      values["sound_slots"] = (sonos_doorbell.default_sound,) * 10
+    else:
+      values["sound_slots"] = tuple(range(10))
+    # index 0 is not a sound, it is kept to index the tuple by sound index.
+    values["use_default"] = (True,) + tuple(
+      "default sound" == name for name in sonos_doorbell.sounds_filelist)
+
+    for name, value in values.items():
+      object.__setattr__(self, name, value)
+
+  def subdev_zones(self, subdev):
+    """ Return the zones a SubDev targets, None if it has no zone group.
+    """
+    for key, names in self.zones:
+      if key == subdev:
+        return names
+    return None
+
+  def __setattr__(self, name, value):
+    raise AttributeError("ConfigSnapshot is read-only.")
+
+  def __delattr__(self, name):
+    raise AttributeError("ConfigSnapshot is read-only.")
+
 class EventHandler(pyinotify.ProcessEvent):
   """ This class is used by inotify to handle filesystem changes events.
   """
@@ -25,19 +116,23 @@ class EventHandler(pyinotify.ProcessEvent):
   def process_IN_CLOSE_WRITE(self, event):
     """ This is a callback handler. Used to handle filesystem events.
 
-      It will check for the config_filename CREATED and MODIFIED events,
+      It will check for the config_filename MODIFIED and REPLACED events,
       and reload the configuration in such cases.
     """
-    if self.configManagerInstance.config_filename in event.pathname:
-      self.configManagerInstance.loadfile()
+    if self.configManagerInstance.config_filename == event.pathname:
+      self.configManagerInstance.schedule_reload()
+
+  process_IN_MOVED_TO = process_IN_CLOSE_WRITE
 
 class ConfigManager():
   """ This class is used to read, write, reset the global config,
 
     It is used by sonosdoorbell service and by webfrontend.
 
-    Configuration is stored in an XML file.
-    Configuration is autoloaded when a file change is detected.
+    Configuration is stored in an XML file, replaced atomically on save.
+    Configuration is autoloaded when a file change is detected. Changes are
+    debounced, and the writes of this instance are recognized (each save
+    creates a new inode) and not reloaded.
 
     NOTE: When an exception occurs, the configuration is generally reset
           and is saved again to the XML file. A backup is also created.
@@ -52,6 +147,16 @@ class ConfigManager():
     """
     self.lextend_ip = lextend_ip
     self.logger = logger or logging.getLogger(__name__)
+    self.listeners = []
+
+    # Incremented each time the settings change, by load or save.
+    self.generation = 0
+    # ConfigSnapshot of the current settings.
+    self.snapshot = None
+    # (inode, mtime, size) of the config file as last loaded or saved.
+    self.file_stat = None
+    self.reload_lock = threading.Lock()
+    self.reload_timer = None
 
     self.config_filename = None
     config_userconfig = os.path.join("/root",
@@ -77,8 +182,9 @@ class ConfigManager():
     # Start watching the config file for changes.
     try:
       self.wm = pyinotify.WatchManager()
-      mask = pyinotify.IN_CLOSE_WRITE
+      mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
       self.notifier = pyinotify.ThreadedNotifier(self.wm, EventHandler(self))
+      self.notifier.setDaemon(True)
       self.notifier.start()
       self.wdd = self.wm.add_watch(os.path.dirname(self.config_filename),
                                    mask,
@@ -87,11 +193,40 @@ class ConfigManager():
       self.logger.error("Could not start observe on %s" % self.config_filename,
                         exc_info=True)
 
+  def stat_file(self):
+    """ Return (inode, mtime, size) of the config file, None if it is missing.
+    """
+    try:
+      st = os.stat(self.config_filename)
+      return (st.st_ino, st.st_mtime, st.st_size)
+    except:
+      return None
+
+  def schedule_reload(self):
+    """ Reload the config file once it has not changed for RELOAD_DELAY.
+    """
+    with self.reload_lock:
+      if self.reload_timer is not None:
+        self.reload_timer.cancel()
+      self.reload_timer = threading.Timer(RELOAD_DELAY, self.reload)
+      self.reload_timer.setDaemon(True)
+      self.reload_timer.start()
+
+  def reload(self):
+    """ Load the config file, unless it is the version already in memory.
+    """
+    with self.reload_lock:
+      self.reload_timer = None
+    if self.stat_file() == self.file_stat:
+      return
+    self.loadfile()
+
   def loadfile(self):
     """ Load config from the XML file, and reset and save in case of error.
     """
     self.logger.info("Loading settings from %s." % self.config_filename)
     try:
+      self.file_stat = self.stat_file()
       self.config = XMLSettings(self.config_filename)
     except:
       self.logger.error("Could not load Config from %s." % self.config_filename,
@@ -146,9 +281,35 @@ class ConfigManager():
 
       self.sonos_doorbell.protocol = self.config.get(section + "/Protocol",
                                                      "10!x1")
+      tmp = self.config.get(section + "/Zones", "")
+      self.sonos_doorbell.zones = parse_zones(tmp)
+      # The protocol header rings all the zones, its SubDev can not select
+      # a zone group as well.
+      subdev = self.sonos_doorbell.protocol[-2:-1]
+      if subdev in self.sonos_doorbell.zones:
+        self.logger.error("Zone group %s ignored, %s is the SubDev of the "
+                          "protocol header %s." %
+                          (subdev, subdev, self.sonos_doorbell.protocol))
+        del self.sonos_doorbell.zones[subdev]
 
     load_general()
     load_sonos_doorbell()
+    self.generation += 1
+    self.snapshot = ConfigSnapshot(self, self.generation)
+    self.notify_listeners()
+
+  def add_listener(self, listener):
+    """ Call listener(configManager) each time the settings are (re)loaded
+        or saved.
+    """
+    self.listeners.append(listener)
+
+  def notify_listeners(self):
+    for listener in self.listeners:
+      try:
+        listener(self)
+      except:
+        self.logger.error("In config listener %s." % listener, exc_info=True)
 
   def save(self):
     """ Save settings to the config file.
@@ -177,17 +338,22 @@ class ConfigManager():
         self.config.put(section + "/Sounds/sound_%s" % i, self.sonos_doorbell.sounds_filelist[i])
 
       self.config.put(section + "/Protocol", self.sonos_doorbell.protocol)
+      self.config.put(section + "/Zones",
+                      format_zones(self.sonos_doorbell.zones))
 
     put_general()
     put_sonos_doorbell()
 
     try:
       self.config.save()
+      self.file_stat = self.stat_file()
+      self.generation += 1
+      self.snapshot = ConfigSnapshot(self, self.generation)
     except:
       self.logger.error("Could not save settings.", exc_info=True)
-
-    # Lazy attempt to solve the bug with using config before it is loaded again;
-    time.sleep(0.5)
+      return
+    # Our own write is not reloaded, the listeners are told here.
+    self.notify_listeners()
 
   def remove_xml_element(self, element_name):
     try:
@@ -198,8 +364,14 @@ class ConfigManager():
       for element in tree.xpath("//%s" % element_name):
         element.getparent().remove(element)
 
-      fi = open(self.config_filename, "r+w")
-      fi.write(etree.tostring(tree))
+      # A unique name, other processes may save the file meanwhile.
+      fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(self.config_filename),
+        prefix=".%s." % os.path.basename(self.config_filename), suffix=".tmp")
+      os.fchmod(fd, 0644)
+      with os.fdopen(fd, "w") as fi:
+        fi.write(etree.tostring(tree))
+      os.rename(tmp_filename, self.config_filename)
     except:
       self.logger.error("While removing %s in %s" % (element_name,
                                                      self.config_filename),
@@ -208,7 +380,7 @@ class ConfigManager():
 
   def reset_service(self, service_name):
     self.remove_xml_element(service_name)
-    self.load()
+    self.loadfile()
     self.save()
 
   def reset_general(self):
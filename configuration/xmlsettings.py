@@ -37,22 +37,123 @@ import xml.dom.minidom
 # -------------------------------------------------------------------
 # convenience functions to provide compatibility with python 2 & 3
 
+import os
 import platform
+import tempfile
+
+def _replace_file( fpath, write ):
+    # write to a temporary file and rename it: readers never see a partial file.
+    # The name is unique, several processes may save the same file at once.
+    directory, name = os.path.split( os.path.abspath( fpath ) )
+    fd, tmp = tempfile.mkstemp( dir=directory, prefix='.' + name + '.',
+                                suffix='.tmp' )
+    os.close( fd )
+    try:
+        # mkstemp creates the file for its owner only
+        os.chmod( tmp, 0o644 )
+        write( tmp )
+        os.rename( tmp, fpath )
+    except:
+        os.remove( tmp )
+        raise
 
 if platform.python_version().startswith( '3' ):
     def _to_string( x ):
         return str(x)
     def _write_file( fpath, doc ):
-        txt = doc.toprettyxml()
-        txt = '\n'.join( [line for line in txt.split('\n') if line.strip()] ) + '\n'
-        open( fpath, 'wt', encoding='utf8' ).write( txt )
+        txt = _serialize( doc )
+        def write( path ):
+            with open( path, 'wt', encoding='utf8' ) as f:
+                f.write( txt )
+        _replace_file( fpath, write )
 else:
     def _to_string( x ):
         return unicode(x)
     def _write_file( fpath, doc ):
-        txt = doc.toprettyxml()
-        txt = '\n'.join( [line for line in txt.split('\n') if line.strip()] ) + '\n'
-        open( fpath, 'wb' ).write( txt.encode('utf8') )
+        txt = _serialize( doc ).encode('utf8')
+        def write( path ):
+            with open( path, 'wb' ) as f:
+                f.write( txt )
+        _replace_file( fpath, write )
+
+# -------------------------------------------------------------------
+# serializer: same output as doc.toprettyxml() without its blank lines
+
+def _escape( data ):
+    return data.replace( '&', '&amp;' ).replace( '<', '&lt;' ). \
+                replace( '"', '&quot;' ).replace( '>', '&gt;' )
+
+class _PartsWriter( object ):
+    def __init__( self, parts ):
+        self.write = parts.append
+
+def _serialize_node( node, indent, parts ):
+    if node.nodeType == node.TEXT_NODE:
+        parts.append( indent + _escape( node.data ) + '\n' )
+        return
+    if node.nodeType != node.ELEMENT_NODE:
+        # comments, CDATA...: written as toprettyxml() writes them, indented
+        node.writexml( _PartsWriter( parts ), indent, '\t', '\n' )
+        return
+    parts.append( indent + '<' + node.tagName )
+    attrs = node.attributes
+    for name in sorted( attrs.keys() ):
+        parts.append( ' %s="%s"' % ( name, _escape( attrs[name].value ) ) )
+    children = node.childNodes
+    if not children:
+        parts.append( '/>\n' )
+    elif len(children) == 1 and children[0].nodeType == node.TEXT_NODE:
+        parts.append( '>' + _escape( children[0].data ) +
+                      '</' + node.tagName + '>\n' )
+    else:
+        parts.append( '>\n' )
+        for c in children:
+            _serialize_node( c, indent + '\t', parts )
+        parts.append( indent + '</' + node.tagName + '>\n' )
+
+def _serialize( doc ):
+    parts = [ '<?xml version="1.0" ?>\n' ]
+    for c in doc.childNodes:
+        _serialize_node( c, '', parts )
+    txt = ''.join( parts )
+    return '\n'.join( [line for line in txt.split('\n') if line.strip()] ) + '\n'
+
+class _PathDict( dict ):
+    # dict keyed by path, whose keys are also indexed by parent path so the
+    # entries below a path are dropped without scanning the whole dict.
+    def __init__( self, *args ):
+        dict.__init__( self, *args )
+        self.children = {}
+        for key in self:
+            self._index( key )
+
+    def __setitem__( self, path, value ):
+        if path not in self:
+            self._index( path )
+        dict.__setitem__( self, path, value )
+
+    def _index( self, path ):
+        while path:
+            parent = path.rpartition('/')[0]
+            children = self.children.setdefault( parent, set() )
+            if path in children:
+                return
+            children.add( path )
+            path = parent
+
+    def drop_subpaths( self, path ):
+        # remove the entries of the paths below path
+        stack = list( self.children.pop( path, () ) )
+        while stack:
+            p = stack.pop()
+            self.pop( p, None )
+            stack.extend( self.children.pop( p, () ) )
+
+    def drop_ancestors( self, path ):
+        # remove the entries of the paths above path
+        while path:
+            path = path.rpartition('/')[0]
+            self.pop( path, None )
 
 # -------------------------------------------------------------------
 # XMLSettingsUncached: main class that deals with xml dom
@@ -66,6 +167,9 @@ class XMLSettingsUncached( object ):
         self.rootNode = self.doc.childNodes[0].nodeName
         self.fpath = fpath
         self.modified = False
+        # path => element, filled as paths are looked up. put() on a path
+        # removes its children, their entries are dropped then.
+        self.index = _PathDict( { '': self.doc.childNodes[0] } )
 
     def save( self, **kwArgs ):
         if self.modified:
@@ -74,31 +178,35 @@ class XMLSettingsUncached( object ):
             self.modified = False
 
     def __get_node( self, path, **kwArgs ):
-        path = self.rootNode + '/' + path.lstrip('/')
+        path = path.strip('/')
+        node = self.index.get( path )
+        if node is not None:
+            return node
         createPath = kwArgs.get( 'createPath', False )
-        node = self.doc
-        for p in path.split('/'):
-            ok = False
-            for c in node.childNodes:
-                if c.nodeName == p:
-                    node = c
-                    ok = True
-                    break
-            if not ok:
-                if not createPath:
-                    return None
-                if node.childNodes and node.childNodes[0].nodeType == self.doc.TEXT_NODE:
-                    node.removeChild( node.childNodes[0] )
-                c = self.doc.createElementNS( None, p )
-                node.appendChild( c )
-                node = c
-        return node
+        parentPath, _, p = path.rpartition('/')
+        node = self.__get_node( parentPath, createPath=createPath )
+        if node is None:
+            return None
+        for c in node.childNodes:
+            if c.nodeName == p:
+                self.index[path] = c
+                return c
+        if not createPath:
+            return None
+        if node.childNodes and node.childNodes[0].nodeType == self.doc.TEXT_NODE:
+            node.removeChild( node.childNodes[0] )
+        c = self.doc.createElementNS( None, p )
+        node.appendChild( c )
+        self.index[path] = c
+        return c
 
     def put( self, path, value ):
         if self.get( path, type(value)() ) == value:
             return
         
         node = self.__get_node( path, createPath=True )
+        if node.childNodes:
+            self.index.drop_subpaths( path.strip('/') )
         while node.childNodes:
             node.removeChild( node.childNodes[-1] )
         v = self.doc.createTextNode( _to_string(value) )
@@ -142,21 +250,27 @@ class XMLSettingsUncached( object ):
 class XMLSettings( object ):
     def __init__( self, fpath ):
         self.xml = XMLSettingsUncached( fpath )
-        self.cache = dict()
-        self.acache = dict()
+        self.cache = _PathDict()
+        # path => { attribute: value }
+        self.acache = _PathDict()
     def save( self, **kwArgs ):
         return self.xml.save( **kwArgs )
     def put( self, path, value ):
         r = self.xml.put( path, value )
-        self.cache.clear()
-        self.acache.clear()
+        # Creating path may drop the text of its ancestors, and the value
+        # replaces its descendants.
+        self.cache.drop_subpaths( path )
+        self.acache.drop_subpaths( path )
+        self.cache.drop_ancestors( path )
         self.cache[path] = value
         return r
     def put_attribute( self, path, attribute, value ):
         r = self.xml.put_attribute( path, attribute, value )
-        self.cache.clear()
-        self.acache.clear()
-        self.acache[(path,attribute)] = value
+        # Creating path may drop the text of its ancestors.
+        self.cache.drop_ancestors( path )
+        if path not in self.acache:
+            self.acache[path] = {}
+        self.acache[path][attribute] = value
         return r
     def get( self, path, defValue='' ):
         x = self.cache.get( path, None )
@@ -170,15 +284,17 @@ class XMLSettings( object ):
                 self.cache[path] = x
         return x
     def get_attribute( self, path, attribute, defValue='' ):
-        x = self.acache.get( (path,attribute), None )
+        x = self.acache.get( path, {} ).get( attribute, None )
         if x == None:
-            x = self.xml.get( path, attribute, None )
+            x = self.xml.get_attribute( path, attribute, None )
             if x == None:
                 x = defValue
             else:
                 if defValue != None:
                     x = type(defValue)(x)
-                self.acache[(path,attribute)] = x
+                if path not in self.acache:
+                    self.acache[path] = {}
+                self.acache[path][attribute] = x
 
         return x
 
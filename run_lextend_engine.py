@@ -6,6 +6,8 @@
 # See the file COPYING for details.
 
 
+import errno
+import json
 import socket
 import traceback
 
@@ -16,41 +18,50 @@ from sonosdoorbell import SonosDeviceManager
 from utils.settings import *
 from utils.sounds_utils import *
 from utils.ip_utils import *
+from utils.dispatch_queue import DispatchQueue
+from utils.executor import BoundedExecutor
+from utils.reactor import Reactor
+from utils.feature_registry import FeatureRegistry
+from utils.sound_server import SoundServer, sound_uri
 
-from threading import Thread
+from threading import Thread, Lock
 import rpyc
 from rpyc.utils.server import ThreadedServer
 
-from time import sleep
+from time import sleep, time
 
-from Queue import Queue
 import re
 
 import logging
 import logging.handlers
 
-logger = logging.getLogger()
 LOG_FILENAME = "/var/log/lextend.engine.log"
-handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, mode="a",
-                                               maxBytes=1024*1024*1,
-                                               backupCount=5)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-handler.setLevel(logging.INFO)
-if logger.handlers:
-    for handler in logger.handlers:
-              logger.removeHandler(handler)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+
+def setup_logging(filename=LOG_FILENAME):
+  """ Send the logs of the engine to a rotating log file.
+  """
+  logger = logging.getLogger()
+  handler = logging.handlers.RotatingFileHandler(filename, mode="a",
+                                                 maxBytes=1024*1024*1,
+                                                 backupCount=5)
+  formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+  handler.setFormatter(formatter)
+  handler.setLevel(logging.INFO)
+  for old_handler in list(logger.handlers):
+    logger.removeHandler(old_handler)
+  logger.addHandler(handler)
+  logger.setLevel(logging.DEBUG)
 
 class RPC_Server(Thread):
   """ Wrapper used to run RPC service in a separate thread.
   """
   def __init__(self, sonosManagerInstance):
     Thread.__init__(self)
+    self.setDaemon(True)
     self.sonosManagerInstance = sonosManagerInstance
   def run(self):
     thread = ThreadedServer(RPC_Service(self.sonosManagerInstance),
+                            hostname=RPC_IP,
                             port=RPC_PORT,
                             protocol_config={"allow_public_attrs":True})
     thread.start()
@@ -70,18 +81,85 @@ def RPC_Service(sonosManagerInstance):
     def exposed_get_sonosPoolManager(self):
       return sonosManagerInstance
 
-  return RPC_Service_Class
+    def exposed_get_status(self):
+      """ Return the pool status as a JSON string, see SonosPoolManager.status
+      """
+      return sonosManagerInstance.status()
 
-def parseExtensionProtocol(data, cfg):
-  """ Parse miniserver udp packet and return parsed data.
+    def exposed_start_discovery(self):
+      """ Start a discovery in the engine, return its status as JSON.
+      """
+      return json.dumps(sonosManagerInstance.start_discovery())
 
-  Packet format: HEADER + PARAMETERS
+    def exposed_get_discovery_status(self):
+      return json.dumps(sonosManagerInstance.discovery_status())
+
+  return RPC_Service_Class
+
+def parseSonosDoorbellArgs(args):
+  """ Parse the arguments of a sonos doorbell packet.
 
   DoorBell Packet format: HEADER + SOUND + VOLUME
     HEADER : a string of any length
     SOUND  : 1 CHAR, ascii, 1..9
     VOLUME : 1 CHAR, ascii, 1..9
 
+  Args:
+      args (str): packet without its header.
+
+  Returns:
+    [sound, volume] if successful, None otherwise.
+  """
+  try:
+    args_sound = int(args[0])
+    if not (1 <= args_sound <= 9):
+      return None
+    args_volume = int(args[1])
+    if not (1 <= args_volume <= 9):
+      return None
+  except:
+    return None
+
+  return [args_sound, args_volume]
+
+def sonosDoorbellHeaders(cfg):
+  """ Return the sonos doorbell headers : the configured one, and one for
+      each zone group, with the group's SubDev in place of the configured one.
+
+  Header format: FeatureNr + Type + SubDev + Function, e.g. "10!x1".
+  """
+  protocol = cfg.sonos_doorbell.protocol
+  zones = cfg.sonos_doorbell.zones
+  if len(protocol) < 2 or not zones:
+    return [protocol]
+  headers = []
+  if protocol[-2] not in zones:
+    headers.append(protocol)
+  for subdev in sorted(zones):
+    headers.append((protocol[:-2] + subdev + protocol[-1], {"zone": subdev}))
+  return headers
+
+def createFeatureRegistry(handlers=None):
+  """ Return a registry holding all the features known by lextend.
+  Args:
+    handlers (dict): feature handlers by feature name.
+  """
+  handlers = handlers or {}
+  registry = FeatureRegistry()
+  registry.register("sonos_doorbell",
+                    sonosDoorbellHeaders,
+                    parseSonosDoorbellArgs,
+                    handlers.get("sonos_doorbell"))
+  return registry
+
+def parseExtensionProtocol(data, cfg):
+  """ Parse miniserver udp packet and return parsed data.
+
+  Packet format: HEADER + PARAMETERS
+
+  NOTE: this compiles the headers for each call, LextendEngine keeps a
+        compiled registry instead.
+
   Args:
       data (str): Input packet.
       cfg (str): configuration instance, it contains expected headers.
@@ -91,26 +169,21 @@ def parseExtensionProtocol(data, cfg):
     Examples:
       {"type":"sonos_doorbell", [sound, volume]}
   """
-  if data.startswith(cfg.sonos_doorbell.protocol):
-    header_len = len(cfg.sonos_doorbell.protocol)
-    try:
-      args_sound = int(data[header_len])
-      if not (1 <= args_sound <= 9):
-        return None
-      args_volume = int(data[header_len+1])
-      if not (1 <= args_volume <= 9):
-        return None
-    except:
-      return None
-
-    return {"type":"sonos_doorbell", "params":[args_sound, args_volume]}
-
-  # unknown protocol
-  else:
-    return None
+  registry = createFeatureRegistry()
+  registry.compile(cfg)
+  ret = registry.parse(data)
+  if ret:
+    del ret["feature"]
+    del ret["context"]
+  return ret
 
 class LextendEngine(object):
-  def __init__(self, logger=None):
+  def __init__(self, config_subdir=CONFIGURATION_SUBDIRECTORY, logger=None):
+    """
+    Args:
+      config_subdir (str): configuration folder, in /root/.config unless it
+                           is an absolute path.
+    """
     self.logger = logger or logging.getLogger(__name__)
     self.logger.info("Starting Lextend Engine.")
 
@@ -119,19 +192,28 @@ class LextendEngine(object):
       local_ip = get_local_ip()
     except:
       local_ip = ""
-    self.cfg = ConfigManager(CONFIGURATION_SUBDIRECTORY,
+    self.cfg = ConfigManager(config_subdir,
                              CONFIGURATION_FILENAME,
                              lextend_ip = local_ip)
 
+    # Packets are dispatched by header, recompiled on each config reload.
+    self.features = createFeatureRegistry(
+      {"sonos_doorbell": self.handle_sonos_doorbell})
+    self.features.compile(self.cfg)
+    self.cfg.add_listener(self.features.compile)
+
     # Create a sonos manager
-    self.sonosPoolManager = SonosPoolManager()
+    # Start from the cached topology, revalidated in background.
+    self.sonosPoolManager = SonosPoolManager(
+      os.path.join("/root", ".config", config_subdir,
+                   SONOS_TOPOLOGY_FILENAME))
     try:
-      self.sonosPoolManager.discover()
+      self.sonosPoolManager.warm_start()
     except:
       self.logger.error("Could not start discovering Sonos.")
 
     # Create a sounds manager
-    self.soundsManager = SoundsManager(CONFIGURATION_SUBDIRECTORY)
+    self.soundsManager = SoundsManager(config_subdir)
 
     # Expose some RPC interfaces for webfrontend
     self.rpc_server_thread = RPC_Server(self.sonosPoolManager)
@@ -146,7 +228,28 @@ class LextendEngine(object):
       else:
         self.logger.info("Detected IP address : %s" % Lextend_ip_address)
         break
-    self.CIFS_HEADER = "x-file-cifs://" + Lextend_ip_address + "/sonos_share/"
+
+    # Serve the sounds over HTTP, the CIFS share is the fallback.
+    self.sound_server = None
+    if SOUND_SERVER_ENABLED:
+      try:
+        self.sound_server = SoundServer(self.soundsManager.sounds_folder,
+                                        SOUND_SERVER_PORT)
+        self.sound_server.start()
+      except:
+        self.sound_server = None
+        self.logger.error("Could not start the sound server, using CIFS.",
+                          exc_info=True)
+
+    # Bell URIs by protocol sound, rebuilt when one of their inputs changes.
+    self.bell_table_lock = Lock()
+    self.bell_table = (None,) * 10
+    self.set_ip_address(Lextend_ip_address)
+    self.cfg.add_listener(self.rebuild_bell_table)
+    self.soundsManager.add_listener(self.rebuild_bell_table)
+
+    # Bells are played by a worker, decoupled from the UDP receiver.
+    self.bell_queue = DispatchQueue(BELL_QUEUE_SIZE)
 
     # Start listening to miniserver.
     self.sock = None
@@ -159,7 +262,67 @@ class LextendEngine(object):
         self.logger.error("Failed to create socket, retrying in 10 seconds.", exc_info=True)
         sleep(10)
 
+  def set_ip_address(self, ip_address):
+    """ Set the sounds URI header from the local IP address.
+    """
+    self.ip_address = ip_address
+    self.CIFS_HEADER = "x-file-cifs://" + ip_address + "/sonos_share/"
+    self.SOUNDS_URI_HEADER = self.CIFS_HEADER
+    if self.sound_server is not None:
+      self.SOUNDS_URI_HEADER = "http://%s:%s/" % (ip_address,
+                                                  SOUND_SERVER_PORT)
+    self.rebuild_bell_table()
+
+  def ip_watcher(self):
+    """ Follow the local IP address, it is part of the bell URIs.
+    """
+    while True:
+      sleep(IP_CHECK_INTERVAL)
+      try:
+        ip_address = get_local_ip()
+        if ip_address and ip_address != self.ip_address:
+          self.logger.info("IP address changed to %s." % ip_address)
+          self.set_ip_address(ip_address)
+      except:
+        self.logger.error("In IP watcher : ", exc_info=True)
+
+  def rebuild_bell_table(self, *args):
+    """ Resolve the sound, URI and duration of each protocol sound.
+
+      bell_table[sound] is (sound_file, uri, duration), or None when there
+      is no sound for this index. Called when the settings, the sounds or
+      the IP address change.
+    """
+    with self.bell_table_lock:
+      snapshot = self.cfg.snapshot
+      table = [None]
+      for sound in range(1, 10):
+        slot = snapshot.sound_slots[sound]
+        sound_file = self.soundsManager.search_path_by_index(
+          slot, snapshot.use_default[slot])
+        if sound_file:
+          uri = sound_uri(self.SOUNDS_URI_HEADER, sound_file)
+          duration = self.soundsManager.get_metadata(sound_file).get("duration")
+          table.append((sound_file, uri, duration))
+        else:
+          table.append(None)
+      self.bell_table = tuple(table)
+    self.logger.info("Bell table rebuilt (config generation %s)." %
+                     snapshot.generation)
+
   def run(self):
+    self.ip_watcher_thread = Thread(target=self.ip_watcher, args=())
+    self.ip_watcher_thread.setDaemon(True)
+    self.ip_watcher_thread.start()
+
+    if ENGINE_MODE == "reactor":
+      self.run_reactor()
+      return
+
+    self.bell_worker_thread = Thread(target=self.bell_worker, args=())
+    self.bell_worker_thread.setDaemon(True)
+    self.bell_worker_thread.start()
+
     self.socket_receiver_thread = Thread(target=self.socket_receiver, args=())
     self.socket_receiver_thread.setDaemon(True)
     self.socket_receiver_thread.start()
@@ -168,50 +331,153 @@ class LextendEngine(object):
     self.socket_receiver_thread.join()
 
   def socket_receiver(self):
+    """ Receive, decode and queue packets. Never waits for the speakers.
+    """
     self.logger.info("Started listening on UDP port %s" % UDP_PORT)
     while True:
       data, addr = self.sock.recvfrom(UDP_PORT)
+      self.handle_packet(data)
+
+  def handle_packet(self, data):
+    """ Decode a packet and hand it to its feature handler.
+    """
+    try:
+      if not self.features.dispatch(data):
+        self.logger.warn("Can't decode this packet : %s" % data)
+    except:
+      self.logger.error("In main loop : ", exc_info=True)
+
+  def handle_sonos_doorbell(self, params, zone=None):
+    """ Queue the bell requested by a sonos doorbell packet.
+    Args:
+      params ([sound, volume]): decoded packet.
+      zone (str): SubDev of a zone group, the bell is played on its zones
+                  only. None for all the zones.
+    """
+    # One consistent view of the settings for the whole packet.
+    snapshot = self.cfg.snapshot
+    if not snapshot.enable:
+      self.logger.info("SonosDoorbell feature disabled !")
+      return
+
+    # Volume percentage from protocol input, or the configured override.
+    volume = snapshot.volumes[params[1]]
+    # Sound from uploads with fallback to defaults, resolved beforehand.
+    bell = self.bell_table[params[0]]
+    zones = snapshot.subdev_zones(zone) if zone else None
+    if bell:
+      sound_file, uri, duration = bell
+      # Pressed again during a bell : played by the bell in progress.
+      if self.sonosPoolManager.merge_bell(uri, volume, duration, zones):
+        return
+      self.logger.info("Queuing %s, %s, %s, %ss, zones %s." %
+                       (sound_file, uri, volume, duration, zones))
+      # Repeated presses of the same bell collapse while waiting.
+      self.bell_queue.put((uri, volume, duration, zones),
+                          key=(uri, volume, zones))
+    else:
+      self.logger.error("Couldn't locate a sound @ index : %s" %
+                        snapshot.sound_slots[params[0]])
+
+  def bell_worker(self):
+    """ Play queued bells one after the other.
+    """
+    while True:
+      uri, volume, duration, zones = self.bell_queue.get()
       try:
-        ret = parseExtensionProtocol(data, self.cfg)
-        if ret:
-          if ret["type"] in "sonos_doorbell":
-            if self.cfg.sonos_doorbell.enable:
-              sound = ret["params"][0]
-              volume = ret["params"][1]
-              # Calculate volume percentage from protocol input.
-              volume = volume * 11            # [0,9] => [0-100]
-              # Apply configured volume override.
-              if self.cfg.sonos_doorbell.volume_override:
-                volume = self.cfg.sonos_doorbell.volume
-              # Search for the sound in uploads and fallback to defaults.
-              if self.cfg.sonos_doorbell.default_sound != 0:
-                sound = self.cfg.sonos_doorbell.default_sound
-
-              default_sound=True
-              if "default sound" != self.cfg.sonos_doorbell.sounds_filelist[sound-1]:
-                default_sound=False
-              sound_file = self.soundsManager.search_path_by_index(sound,
-                                                                  default_sound)
-              if sound_file:
-                split = os.path.split(sound_file)
-                sound_file = os.path.join(os.path.split(split[0])[1], split[1])
-                smb_path = self.CIFS_HEADER + sound_file
-                self.logger.info("Playing %s, %s, %s." % (sound_file, 
-                                                         smb_path,
-                                                         volume))
-                self.sonosPoolManager.pause_play_bell_resume(smb_path, volume)
-              else:
-                self.logger.error("Couldn't locate a sound @ index : %s" % sound)
-            else:
-              self.logger.info("SonosDoorbell feature disabled !")
-          else:
-            self.logger.error("Packet type not known : %s" % ret["type"])
-        else:
-          self.logger.warn("Can't decode this packet : %s" % data)
+        self.logger.info("Playing %s, %s." % (uri, volume))
+        self.sonosPoolManager.pause_play_bell_resume(uri, volume, duration,
+                                                     zones)
       except:
-        self.logger.error("In main loop : ", exc_info=True)
+        self.logger.error("In bell worker : ", exc_info=True)
+      self.logger.info("Bell queue stats : %s" % self.bell_queue.stats)
+
+  def run_reactor(self):
+    """ Run the engine in a single select() loop.
+
+      Packets are read from a non blocking socket. The bell steps are
+      scheduled as tasks in a bounded executor, each step having a deadline
+      after which its calls that did not start yet are cancelled.
+    """
+    self.executor = BoundedExecutor(SONOS_EXECUTOR_WORKERS, name="sonos")
+    self.reactor = Reactor(self.executor)
+    self.bell_steps = None
+
+    self.sock.setblocking(0)
+    self.reactor.add_reader(self.sock.fileno(), self.on_readable)
+    self.logger.info("Started listening on UDP port %s (reactor)" % UDP_PORT)
+    self.reactor.run_forever()
+
+  def on_readable(self):
+    """ Drain the socket, then start a bell if none is running.
+    """
+    while True:
+      try:
+        data, addr = self.sock.recvfrom(UDP_PORT)
+      except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+      self.handle_packet(data)
+    self.start_next_bell()
+
+  def start_next_bell(self):
+    if self.bell_steps is not None:
+      return
+    item = self.bell_queue.get_nowait()
+    if item is None:
+      return
+    uri, volume, duration, zones = item
+    self.logger.info("Playing %s, %s." % (uri, volume))
+    self.bell_steps = self.sonosPoolManager.bell_steps(uri, volume, duration,
+                                                       zones)
+    self.run_next_step()
+
+  def run_next_step(self):
+    if not self.bell_steps:
+      self.bell_steps = None
+      self.logger.info("Bell queue stats : %s" % self.bell_queue.stats)
+      self.start_next_bell()
+      return
+
+    name, calls, deadline = self.bell_steps.pop(0)
+    step = {"name": name, "pending": len(calls), "start": time(),
+            "finished": False, "futures": []}
+    step["timer"] = self.reactor.call_later(deadline, self.on_step_deadline,
+                                            step)
+    for call in calls:
+      step["futures"].append(self.reactor.run_in_executor(
+        lambda future, step=step: self.on_step_call_done(step, future), call))
+
+  def on_step_call_done(self, step, future):
+    if future.cancelled():
+      self.logger.error("Bell step %s call cancelled." % step["name"])
+    elif future.exception() is not None:
+      self.logger.error("Bell step %s failed : %s" % (step["name"],
+                                                      future.exception()))
+    step["pending"] -= 1
+    if step["pending"] == 0 and not step["finished"]:
+      step["finished"] = True
+      step["timer"].cancel()
+      self.logger.info("Bell step %s done in %.3fs." % (step["name"],
+                                                         time() - step["start"]))
+      self.run_next_step()
+
+  def on_step_deadline(self, step):
+    """ Cancel the calls of a late step that did not start yet.
+      The next step is started once the running calls are done, as it
+      relies on their results (e.g. the ungroup step on the regroup plan).
+    """
+    if step["finished"]:
+      return
+    self.logger.error("Bell step %s missed its deadline, %s call(s) pending."
+                      % (step["name"], step["pending"]))
+    # Cancelled calls are counted as done by on_step_call_done.
+    for future in step["futures"]:
+      future.cancel()
 
 def main():
+  setup_logging()
   Lextend_engine = LextendEngine()
   Lextend_engine.run()
 
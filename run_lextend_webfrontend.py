@@ -9,17 +9,18 @@
 import os
 import time
 from flask import Flask, render_template, request, session, url_for, redirect
+from flask import jsonify, Request
 from werkzeug.utils import secure_filename
 
-from configuration import ConfigManager
+from configuration import ConfigManager, parse_zones, format_zones
 from webfrontend import pam_helper
+from webfrontend.rpc_client import RPCClient
+from webfrontend.status_cache import StatusCache
 
 from utils.settings import *
 from utils.sounds_utils import *
 from utils.ip_utils import *
 
-import rpyc
-
 import ipaddress
 
 import threading
@@ -43,8 +44,25 @@ logger.setLevel(logging.DEBUG)
 
 logger.info("Starting Lextend Webfrontend.")
 
+class StreamingRequest(Request):
+  """ Streams uploaded files to the sounds uploads folder as they arrive,
+    instead of buffering them in memory or in /tmp.
+  """
+  def _get_file_stream(self, total_content_length, content_type,
+                       filename=None, content_length=None):
+    return app.config["soundsManager"].create_upload_file()
+
 app = Flask(__name__, static_folder="webfrontend/static",
                       template_folder="webfrontend/templates/")
+app.request_class = StreamingRequest
+
+@app.teardown_request
+def discard_uploads(exception=None):
+  """ Remove the uploaded files that were not committed to a slot.
+  """
+  if request.method == "POST":
+    for file in request.files.values():
+      app.config["soundsManager"].discard_upload(file.stream)
 
 @app.route("/", methods=['GET', 'POST'])
 def root():
@@ -72,13 +90,8 @@ def settings_sonos_doorbell():
   cfg = app.config["cfg"]
   soundsManager = app.config["soundsManager"]
 
-  # Connect to the RPC server
-  remote_sonosPoolManager = None
-  try:
-    conn = rpyc.connect(RPC_IP, RPC_PORT)
-    remote_sonosPoolManager = conn.root.get_sonosPoolManager()
-  except:
-    logger.error("Could not connect to RPC server.")
+  rpc = app.config["rpc"]
+  discovery = None
 
   if request.method == 'POST':
     rf = request.form               # just a shortcut
@@ -111,6 +124,9 @@ def settings_sonos_doorbell():
       try:
         cfg.sonos_doorbell.protocol = str(rf["protocol"])
       except: pass
+      try:
+        cfg.sonos_doorbell.zones = parse_zones(str(rf["sonos_doorbell.zones"]))
+      except: pass
 
       # Handle files
       for i in range(1, 10):
@@ -123,11 +139,15 @@ def settings_sonos_doorbell():
             file = request.files["sound_file_%s" % i]
             if file:
               filename = secure_filename(file.filename)
-              cfg.sonos_doorbell.sounds_filelist[i-1] = filename
-              soundsManager.delete_file_by_index(i)
-              file.save(soundsManager.create_upload_path(i, filename))
+              # Already on disk, it is moved into the slot.
+              path = soundsManager.commit_upload(file.stream, i, filename)
+              if path:
+                cfg.sonos_doorbell.sounds_filelist[i-1] = filename
+                # Index the new sound now rather than on the first bell.
+                soundsManager.get_metadata(path)
           except:
-            logger.error("Could not upload file : %s." % file.filename)
+            logger.error("Could not upload file : %s." % file.filename,
+                         exc_info=True)
 
       cfg.save()
     elif "Reset" == action:
@@ -136,21 +156,57 @@ def settings_sonos_doorbell():
 
       cfg.reset_sonos_doorbell()
     elif "Discover" == action:
+      # Runs in the engine, the page polls for its progress.
       try:
-        remote_sonosPoolManager.discover()
+        discovery = rpc.start_discovery()
       except:
         logger.error("Could not run sonos discovery.", exc_info=True)
     else:
       logger.error("Unknown post action : %s" % action)
 
-  sonos_list = None
+  # Served from the cache, possibly stale, only the first view waits for the
+  # engine.
+  status, status_updated, status_stale = app.config["status"].get()
+  sonos_list = status["devices"] if status else None
+  if status_updated:
+    status_updated = time.strftime("%Y-%m-%d %H:%M:%S",
+                                   time.localtime(status_updated))
+
+  sound_durations = []
+  for i in range(1, 10):
+    default_sound = cfg.sonos_doorbell.sounds_filelist[i-1] == "default sound"
+    path = soundsManager.search_path_by_index(i, default_sound)
+    duration = None
+    if path:
+      duration = soundsManager.get_metadata(path).get("duration")
+    sound_durations.append(duration)
+
+  return render_template("/settings/sonos_doorbell.html", cfg=cfg,
+                         sonos_list=sonos_list,
+                         status_updated=status_updated,
+                         status_stale=status_stale,
+                         discovery=discovery,
+                         sound_durations=sound_durations,
+                         zones=format_zones(cfg.sonos_doorbell.zones))
+
+@app.route("/settings/sonos_doorbell/discovery")
+def sonos_doorbell_discovery():
+  """ Discovery job status, polled by the settings page.
+  """
+  if not "username" in session:
+    return redirect(url_for("signin"))
+
+  status_cache = app.config["status"]
   try:
-    logger.info("Sonos devices list : " % remote_sonosPoolManager.devices_list)
-    sonos_list = remote_sonosPoolManager.devices_list
+    job = app.config["rpc"].get_discovery_status()
   except:
-    logger.error("Could not get sonos devices list.")
-
-  return render_template("/settings/sonos_doorbell.html", cfg=cfg, sonos_list=sonos_list)
+    logger.error("Could not get the discovery status.", exc_info=True)
+    job = {"state": "failed", "error": "engine unreachable"}
+  # Fetch the new devices once the job is over.
+  if job.get("finished") and (status_cache.updated is None or
+                              status_cache.updated < job["finished"]):
+    status_cache.invalidate()
+  return jsonify(job=job, status_updated=status_cache.updated)
 
 @app.route("/settings/general", methods = ['GET', 'POST'])
 def settings_general():
@@ -261,6 +317,11 @@ def main():
                                     CONFIGURATION_FILENAME,
                                     lextend_ip = local_ip)
   app.config["soundsManager"] = SoundsManager(CONFIGURATION_SUBDIRECTORY)
+  app.config["rpc"] = RPCClient(RPC_IP, RPC_PORT)
+  # The status has its own connection, a slow get_status does not hold
+  # the discovery calls of the pages.
+  app.config["status"] = StatusCache(RPCClient(RPC_IP, RPC_PORT).get_status,
+                                     STATUS_CACHE_TTL)
 
   # Create and run the web app.
   app.secret_key                   = "Ag~EpxZ3&,h28fA.Ze;iZ1EO,F4e5dRZ)"
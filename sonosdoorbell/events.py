@@ -0,0 +1,203 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import httplib
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.etree import cElementTree as ElementTree
+
+import logging
+
+AVTRANSPORT_EVENT_PATH = "/MediaRenderer/AVTransport/Event"
+
+def get_listen_ip(device_ip, device_port=1400):
+  """ Return the local ip address used to reach device_ip.
+  """
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    s.connect((device_ip, device_port))
+    return s.getsockname()[0]
+  finally:
+    s.close()
+
+def parse_last_change(body):
+  """ Extract the AVTransport variables from a GENA NOTIFY body.
+  Args:
+    body (str): NOTIFY body, a propertyset holding an escaped LastChange.
+  Returns:
+    {variable_name: value} e.g. {"TransportState": "PLAYING"}
+  """
+  variables = {}
+  propertyset = ElementTree.fromstring(body)
+  for element in propertyset.iter():
+    if element.tag.endswith("LastChange") and element.text:
+      event = ElementTree.fromstring(element.text.encode("utf-8"))
+      for variable in event.iter():
+        if "val" in variable.attrib:
+          name = variable.tag.split("}")[-1]
+          variables[name] = variable.attrib["val"]
+  return variables
+
+class Subscription():
+  """ A GENA subscription to the AVTransport events of one device.
+
+    The last received values are kept in self.variables, wait_for() is used
+    to block until an event satisfies a condition.
+  """
+  def __init__(self, listener, device_ip, device_port=1400,
+               path=AVTRANSPORT_EVENT_PATH, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.listener = listener
+    self.device_ip = device_ip
+    self.device_port = device_port
+    self.path = path
+    self.sid = None
+    self.variables = {}
+    self.condition = threading.Condition()
+
+  def _request(self, method, headers, timeout=5):
+    conn = httplib.HTTPConnection(self.device_ip, self.device_port,
+                                  timeout=timeout)
+    try:
+      conn.request(method, self.path, headers=headers)
+      response = conn.getresponse()
+      response.read()
+      return response
+    finally:
+      conn.close()
+
+  def subscribe(self, duration=300):
+    callback = "<http://%s:%s/>" % (self.listener.address(self.device_ip),
+                                    self.listener.port)
+    response = self._request("SUBSCRIBE", {"CALLBACK": callback,
+                                           "NT": "upnp:event",
+                                           "TIMEOUT": "Second-%s" % duration})
+    if response.status != 200:
+      raise Exception("SUBSCRIBE to %s failed : %s" % (self.device_ip,
+                                                       response.status))
+    self.sid = response.getheader("sid")
+    self.listener.register(self)
+
+  def unsubscribe(self):
+    if self.sid is None:
+      return
+    self.listener.unregister(self)
+    try:
+      self._request("UNSUBSCRIBE", {"SID": self.sid})
+    except:
+      self.logger.warn("UNSUBSCRIBE from %s failed." % self.device_ip,
+                       exc_info=True)
+    self.sid = None
+
+  def clear(self):
+    """ Forget the received values, before waiting for new events.
+    """
+    with self.condition:
+      self.variables = {}
+
+  def notify(self, variables):
+    """ Called by the listener when an event is received.
+    """
+    with self.condition:
+      self.variables.update(variables)
+      self.condition.notifyAll()
+
+  def wait_for(self, predicate, timeout):
+    """ Wait until predicate(self.variables) is true.
+    Returns:
+      True if the predicate became true, False if the timeout expired.
+    """
+    deadline = time.time() + timeout
+    with self.condition:
+      while not predicate(self.variables):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.condition.wait(remaining)
+      return True
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class EventListener():
+  """ HTTP server receiving the GENA NOTIFY requests sent by the devices.
+
+    It is started lazily by the first subscribe() call.
+  """
+  def __init__(self, port=1410, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.port = port
+    self.server = None
+    self.subscriptions = {}
+    # Events received before the SUBSCRIBE response, by sid.
+    self.early_events = {}
+    self.lock = threading.Lock()
+
+  def address(self, device_ip):
+    return get_listen_ip(device_ip)
+
+  def start(self):
+    with self.lock:
+      if self.server is not None:
+        return
+      listener = self
+
+      class Handler(BaseHTTPRequestHandler):
+        def do_NOTIFY(self):
+          length = int(self.headers.getheader("content-length", 0))
+          body = self.rfile.read(length)
+          listener.dispatch(self.headers.getheader("sid"), body)
+          self.send_response(200)
+          self.end_headers()
+
+        def log_message(self, format, *args):
+          pass
+
+      self.server = _ThreadedHTTPServer(("", self.port), Handler)
+      thread = threading.Thread(target=self.server.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+      self.logger.info("Listening for Sonos events on port %s." % self.port)
+
+  def subscribe(self, device_ip, device_port=1400,
+                path=AVTRANSPORT_EVENT_PATH):
+    """ Subscribe to the events of a device.
+    Returns:
+      subscription (Subscription) : call unsubscribe() when done.
+    """
+    self.start()
+    subscription = Subscription(self, device_ip, device_port, path)
+    subscription.subscribe()
+    return subscription
+
+  def register(self, subscription):
+    with self.lock:
+      self.subscriptions[subscription.sid] = subscription
+      body = self.early_events.pop(subscription.sid, None)
+    if body is not None:
+      self.dispatch(subscription.sid, body)
+
+  def unregister(self, subscription):
+    with self.lock:
+      self.subscriptions.pop(subscription.sid, None)
+
+  def dispatch(self, sid, body):
+    with self.lock:
+      subscription = self.subscriptions.get(sid)
+      if subscription is None:
+        if len(self.early_events) > 32:
+          self.early_events.clear()
+        self.early_events[sid] = body
+        return
+    try:
+      subscription.notify(parse_last_change(body))
+    except:
+      self.logger.error("Could not parse event from %s." %
+                        subscription.device_ip, exc_info=True)
@@ -0,0 +1,118 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import time
+
+from utils.executor import run_batch
+
+import logging
+
+# Fade curves : progress in [0, 1] => volume progress in [0, 1]
+CURVES = {
+  "linear":   lambda x: x,
+  "ease_in":  lambda x: x * x,
+  "ease_out": lambda x: 1 - (1 - x) * (1 - x),
+}
+
+class FadeScheduler():
+  """ Fades the volume of several devices at once, on a shared timer.
+
+    Volumes are computed from the known start volume of each device, so a
+    step costs one SET per device whose volume changes, and no GET. With
+    use_ramp, the fades in are left to the speaker with one RampToVolume
+    call per device. The speaker then ramps with its own duration and curve
+    (about 17s) and fade() returns at once. The fades out are still done in
+    steps, they must be over before the devices are stopped.
+  """
+  def __init__(self, executor, duration=1.0, step=0.1, curve="linear",
+               use_ramp=False, logger=None):
+    """
+    Args:
+      executor (BoundedExecutor): runs the SOAP calls.
+      duration (float): seconds, 0 sets the target volumes at once.
+      step (float): seconds between two volume updates.
+      curve (str): a CURVES key.
+      use_ramp (bool): use the Sonos RampToVolume action for the fades in,
+                       duration and curve do not apply to them.
+    """
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.executor = executor
+    self.duration = duration
+    self.step = step
+    self.curve = CURVES[curve]
+    self.use_ramp = use_ramp
+
+  def fade(self, targets):
+    """ Fade devices from their start volume to their end volume.
+    Args:
+      targets ([(SonosDeviceManager, start, end), ...])
+    """
+    if not targets:
+      return
+    start = time.time()
+    stepped = targets
+    if self.use_ramp:
+      ramped = [target for target in targets if target[2] > target[1]]
+      stepped = [target for target in targets if target[2] <= target[1]]
+      if ramped:
+        stepped += self.ramp(ramped)
+    if stepped:
+      self.steps(stepped)
+    self.logger.info("Faded %s device(s) in %.3fs." % (len(targets),
+                                                       time.time() - start))
+
+  def set_volumes(self, volumes):
+    """ Set the volumes concurrently.
+    Args:
+      volumes ([(SonosDeviceManager, volume), ...])
+    """
+    def set_volume(device, volume):
+      device.device.volume = volume
+    batch = run_batch(self.executor,
+                      [(device.ip, lambda d=device, v=volume: set_volume(d, v))
+                       for device, volume in volumes],
+                      self.step * 10)
+    for label, error in batch.errors.items():
+      self.logger.error("Could not set volume on %s : %s" % (label, error))
+
+  def steps(self, targets):
+    count = max(1, int(round(self.duration / self.step)))
+    current = dict((device.ip, start) for device, start, end in targets)
+    for i in range(1, count + 1):
+      tick = time.time()
+      progress = self.curve(float(i) / count)
+      volumes = []
+      for device, start, end in targets:
+        volume = int(round(start + (end - start) * progress))
+        if volume != current[device.ip]:
+          current[device.ip] = volume
+          volumes.append((device, volume))
+      if volumes:
+        self.set_volumes(volumes)
+      if i < count:
+        time.sleep(max(0, self.step - (time.time() - tick)))
+
+  def ramp(self, targets):
+    """ Start the ramps, without waiting for them to be over.
+    Returns:
+      the targets where RampToVolume failed, to be faded in steps.
+    """
+    def ramp_to(device, end):
+      device.device.renderingControl.RampToVolume([
+        ("InstanceID", 0),
+        ("Channel", "Master"),
+        ("RampType", "SLEEP_TIMER_RAMP_TYPE"),
+        ("DesiredVolume", end),
+        ("ResetVolumeAfter", False),
+        ("ProgramURI", "")])
+    batch = run_batch(self.executor,
+                      [(device.ip, lambda d=device, v=end: ramp_to(d, v))
+                       for device, start, end in targets],
+                      self.step * 10)
+    for label, error in batch.errors.items():
+      self.logger.error("RampToVolume failed on %s : %s" % (label, error))
+    return [target for target in targets
+            if target[0].ip not in batch.results]
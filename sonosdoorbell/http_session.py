@@ -0,0 +1,112 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import threading
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+
+class SessionPool():
+  """ One keep-alive HTTP session per device (host:port).
+
+    SoCo sends every SOAP request with requests.post(), which opens a new
+    connection each time. Routing these calls through a per-device session
+    reuses the connections to port 1400 of the speakers.
+  """
+  def __init__(self, connect_timeout=2, read_timeout=10, maxsize=8,
+               logger=None):
+    """
+    Args:
+      connect_timeout (float): seconds to establish a connection.
+      read_timeout (float): seconds to wait for a response.
+      maxsize (int): connections kept open per device, at least the number
+                     of threads that may send to a device at once.
+    """
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.timeout = (connect_timeout, read_timeout)
+    self.maxsize = maxsize
+    self.sessions = {}
+    self.requests_count = {}
+    self.lock = threading.Lock()
+
+  def session(self, host):
+    """ Return the session of a device, create it if needed.
+    """
+    with self.lock:
+      session = self.sessions.get(host)
+      if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.maxsize)
+        session.mount("http://", adapter)
+        self.sessions[host] = session
+        self.requests_count[host] = 0
+      self.requests_count[host] += 1
+      return session
+
+  def request(self, method, url, **kwargs):
+    kwargs.setdefault("timeout", self.timeout)
+    host = urlparse.urlsplit(url).netloc
+    return self.session(host).request(method, url, **kwargs)
+
+  def stats(self, host=None):
+    """ Return the connection reuse counters.
+    Args:
+      host (str): "ip:port" of a device, None for all the devices.
+    Returns:
+      {"requests": n, "connections": n, "reused": n}
+    """
+    with self.lock:
+      hosts = [host] if host else list(self.sessions.keys())
+      stats = {"requests": 0, "connections": 0, "reused": 0}
+      for h in hosts:
+        session = self.sessions.get(h)
+        if session is None:
+          continue
+        connections = 0
+        pools = session.get_adapter("http://").poolmanager.pools
+        for key in pools.keys():
+          connections += pools[key].num_connections
+        stats["requests"] += self.requests_count[h]
+        stats["connections"] += connections
+      stats["reused"] = max(0, stats["requests"] - stats["connections"])
+      return stats
+
+class RequestsShim():
+  """ Stands for the requests module in SoCo, sending through a SessionPool.
+  """
+  def __init__(self, pool):
+    self.pool = pool
+
+  def request(self, method, url, **kwargs):
+    return self.pool.request(method, url, **kwargs)
+
+  def get(self, url, **kwargs):
+    return self.pool.request("GET", url, **kwargs)
+
+  def post(self, url, data=None, **kwargs):
+    return self.pool.request("POST", url, data=data, **kwargs)
+
+  def __getattr__(self, name):
+    # exceptions, codes, ... come from the real module.
+    return getattr(requests, name)
+
+def install(pool, logger=None):
+  """ Make SoCo send its HTTP requests through pool.
+  """
+  logger = logger or logging.getLogger(__name__)
+  try:
+    from SoCo.soco import core, services
+  except ImportError:
+    logger.warn("Could not install the HTTP session pool in SoCo.",
+                exc_info=True)
+    return
+  shim = RequestsShim(pool)
+  for module in (core, services):
+    if hasattr(module, "requests"):
+      module.requests = shim
@@ -5,88 +5,696 @@
 
 import traceback
 
+import json
 import time
 import threading
+import collections
 
 from SoCo import soco
 
+from utils.executor import BoundedExecutor, run_batch
+
+from events import EventListener
+from topology_cache import TopologyCache
+import http_session
+from fade import FadeScheduler
+
 import logging
 
 FADE_OUT_ENABLED          = False
+# Fades are run by the pool for all the devices at once.
+FADE_DURATION             = 1.0
+FADE_STEP                 = 0.1
+FADE_CURVE                = "linear"   # linear, ease_in or ease_out
+# Let the speakers fade in with RampToVolume, one call per device.
+FADE_USE_RAMP             = False
+
+# Snapshot the state from the media info, without downloading the queue, and
+# issue the reads concurrently.
+LIGHTWEIGHT_SNAPSHOT_ENABLED = True
+# Threads shared by the devices of a pool for their SOAP calls.
+SONOS_WORKERS             = 8
+
+# Send the SOAP calls over keep-alive connections, one session per device.
+HTTP_KEEPALIVE_ENABLED    = True
+HTTP_CONNECT_TIMEOUT      = 2
+HTTP_READ_TIMEOUT         = 10
+
+# Detect the end of a bell with AVTransport events, polling is the fallback.
+EVENTS_ENABLED            = True
+EVENT_LISTENER_PORT       = 1410
+# Seconds to wait for the bell to start, then between two safety polls.
+EVENT_START_TIMEOUT       = 5
+EVENT_SAFETY_POLL         = 10
+# When the sound duration is known, status is first checked this many seconds
+# after its expected end.
+BELL_END_MARGIN           = 0.5
+
+# Seconds the status served to the webfrontend is reused before being read
+# again from the devices.
+STATUS_MAX_AGE            = 5
+STATUS_STEP_DEADLINE      = 10
+# Threads reading the status, apart from the ones playing the bells.
+STATUS_WORKERS            = 2
+
+# Presses that arrive during a bell on the same zones join it instead of
+# being played after it : "restart" stops the current sound and plays the new
+# one at once, "extend" plays it once the current one ends, None disables it.
+BELL_MERGE_MODE           = "restart"
+# Sounds played at most by one bell session, later presses are queued.
+BELL_SESSION_MAX_PLAYS    = 5
+
+# Phase timestamps of the last bells, see SonosPoolManager.bell_timings.
+BELL_TIMINGS_SIZE         = 100
+
+# Deadlines (seconds) of the bell steps.
+PAUSE_STEP_DEADLINE       = 10
+REGROUP_STEP_DEADLINE     = 10
+PLAY_STEP_DEADLINE        = 120
+UNGROUP_STEP_DEADLINE     = 10
+RESUME_STEP_DEADLINE      = 30
+
+def read_group(device):
+  """ Return the group of a SoCo device, read from the speaker.
+    SoCo keeps the zone group state for a few seconds, a bell right after
+    the previous one would otherwise see the groups made for that bell.
+  """
+  service = device.zoneGroupTopology
+  if hasattr(getattr(service, "cache", None), "clear"):
+    service.cache.clear()
+  zgs_cache = getattr(device, "_zgs_cache", None)
+  if hasattr(zgs_cache, "clear"):
+    zgs_cache.clear()
+  else:
+    device._zgs_cache = None
+  return device.group
 
-class FuncThread(threading.Thread):
-  """ Run a function in a thread.
+class RegroupPlan():
+  """ Describes how the zones are moved for a bell, and back.
   """
-  def __init__(self, target, *args):
-      self._target = target
-      self._args = args
-      threading.Thread.__init__(self)
+  def __init__(self, master, members, moves, unjoin_master):
+    # Device the bell is played on.
+    self.master = master
+    # Devices that take part in the bell, master included.
+    self.members = members
+    # Devices that are not in the master's group yet, they join it.
+    self.moves = moves
+    # True if master was a group member, it leaves its group first.
+    self.unjoin_master = unjoin_master
+    # Events of the master, subscribed while regrouping (Subscription).
+    self.subscription = None
+
+class BellSession():
+  """ A bell in progress, from the pause of the zones to their restore.
 
-  def run(self):
-      self._target(*self._args)
+    Presses merged into the session are played on the zones that are
+    already paused and grouped, the state saved before the first bell is
+    restored once, at the end of the session.
+  """
+  def __init__(self, zones):
+    self.zones = zones
+    # "pause", "play", then "restore" once no press can be merged anymore.
+    self.phase = "pause"
+    self.plays = 0
+    # (uri, volume, duration) of the last merged press, not played yet.
+    self.pending = None
+    # Set to stop the current sound early, in "restart" mode.
+    self.interrupt = threading.Event()
+    self.master = None
+    # time.time() when the first sound started.
+    self.play_started = None
+    self.lock = threading.Lock()
 
 class SonosPoolManager():
   """ Handles a pool of Sonos devices
   """
-  def __init__(self, logger=None):
+  def __init__(self, cache_filename=None, logger=None):
     self.logger = logger or logging.getLogger(__name__)
 
     self.devices_list = []
+    self.executor = BoundedExecutor(SONOS_WORKERS, name="sonos")
+    self.status_executor = BoundedExecutor(STATUS_WORKERS, name="sonos-status")
 
-  def discover(self):
-    self.devices_list = []
-    discovered = soco.discover()
-    if discovered != None:
-      for sonos in list(discovered):
-        self.logger.info("Discovered sonos : %s." % sonos.ip_address)
-        self.devices_list.append(SonosDeviceManager(sonos.ip_address))
+    self.fader = FadeScheduler(self.executor, FADE_DURATION, FADE_STEP,
+                               FADE_CURVE, FADE_USE_RAMP)
+
+    self.http_pool = None
+    if HTTP_KEEPALIVE_ENABLED:
+      # All the workers may send to the same device at once, e.g. the
+      # concurrent reads of snapshot_lightweight.
+      self.http_pool = http_session.SessionPool(HTTP_CONNECT_TIMEOUT,
+                                                HTTP_READ_TIMEOUT,
+                                                SONOS_WORKERS + STATUS_WORKERS)
+      http_session.install(self.http_pool)
+
+    self.event_listener = None
+    if EVENTS_ENABLED:
+      self.event_listener = EventListener(EVENT_LISTENER_PORT)
+
+    self.topology_cache = None
+    if cache_filename:
+      self.topology_cache = TopologyCache(cache_filename)
+
+    # One dict per bell : time.time() at "start", "paused", "regrouped",
+    # "playing" (first sound started), "ended" (end detected) and "restored".
+    self.bell_timings = collections.deque(maxlen=BELL_TIMINGS_SIZE)
+
+    # BellSession of the bell in progress, None between the bells.
+    self.session = None
+    self.session_lock = threading.Lock()
+
+    # Only one discovery at a time, see start_discovery().
+    self.discover_lock = threading.Lock()
+    self.discovery_lock = threading.Lock()
+    self.discovery = {"state": "idle", "progress": None, "started": None,
+                      "finished": None, "found": None, "error": None}
+
+    # Serialized status(), and the time it was built.
+    self.status_lock = threading.Lock()
+    self.status_json = None
+    self.status_time = 0
+
+  def create_device(self, ip):
+    return SonosDeviceManager(ip, event_listener=self.event_listener,
+                              executor=self.executor,
+                              http_pool=self.http_pool)
+
+  def warm_start(self):
+    """ Load the devices from the topology cache, then revalidate it by
+        running a discovery in a background thread.
+    """
+    if self.topology_cache is not None:
+      entries = self.topology_cache.load()
+      devices_list = []
+      for entry in entries:
+        device = self.create_device(entry["ip"])
+        device.zone_name = entry.get("zone_name")
+        devices_list.append(device)
+      self.devices_list = devices_list
+      self.logger.info("Loaded %s sonos from the topology cache." %
+                       len(self.devices_list))
+
+    thread = threading.Thread(target=self.revalidate)
+    thread.setDaemon(True)
+    thread.start()
+
+  def revalidate(self):
+    try:
+      self.discover()
+    except:
+      self.logger.error("Could not revalidate the sonos topology.",
+                        exc_info=True)
+
+  def discover(self, progress=None):
+    """ Discover the devices and update the pool incrementally.
+
+      Managers of devices that are still there are kept, new devices are
+      appended and missing ones removed. The new list is built aside and
+      replaces the old one in a single assignment, bells keep using the old
+      one meanwhile.
+    Args:
+      progress (callable): progress(step) is called with "searching",
+                           "updating" and "saving".
+    """
+    progress = progress or (lambda step: None)
+    with self.discover_lock:
+      progress("searching")
+      discovered = soco.discover()
+      if discovered == None:
+        self.logger.warn("No sonos discovered, keeping the current pool.")
+        return
+
+      progress("updating")
+      ips = sorted(sonos.ip_address for sonos in discovered)
+      current = dict((device.ip, device) for device in self.devices_list)
+      devices_list = [device for device in self.devices_list
+                      if device.ip in ips]
+      for ip in ips:
+        if ip not in current:
+          self.logger.info("Discovered sonos : %s." % ip)
+          devices_list.append(self.create_device(ip))
+      for ip in current:
+        if ip not in ips:
+          self.logger.info("Sonos %s is gone." % ip)
+      self.devices_list = devices_list
+      self.status_time = 0
+
+      progress("saving")
+      self.save_topology()
+
+  def start_discovery(self):
+    """ Run discover() in a background thread, unless it is already running.
+    Returns:
+      discovery_status()
+    """
+    with self.discovery_lock:
+      if self.discovery["state"] != "running":
+        self.discovery = {"state": "running", "progress": None,
+                          "started": time.time(), "finished": None,
+                          "found": None, "error": None}
+        thread = threading.Thread(target=self.run_discovery)
+        thread.setDaemon(True)
+        thread.start()
+      return dict(self.discovery)
+
+  def run_discovery(self):
+    def progress(step):
+      with self.discovery_lock:
+        self.discovery["progress"] = step
+    try:
+      self.discover(progress)
+      state, error = "done", None
+    except Exception as e:
+      self.logger.error("Discovery failed.", exc_info=True)
+      state, error = "failed", str(e)
+    with self.discovery_lock:
+      self.discovery.update({"state": state, "error": error,
+                             "finished": time.time(),
+                             "found": len(self.devices_list)})
 
-  def pause_play_bell_resume(self, uri, volume):
+  def discovery_status(self):
+    """ Return the state of the last discovery job.
+    Returns:
+      {"state": "idle"|"running"|"done"|"failed", "progress": step,
+       "started": timestamp, "finished": timestamp, "found": devices count,
+       "error": message}
+    """
+    with self.discovery_lock:
+      return dict(self.discovery)
+
+  def describe(self, device):
+    """ Return the topology cache entry of a device.
+    """
+    device.zone_name = device.device.player_name
+    return {"ip": device.ip,
+            "uid": device.device.uid,
+            "zone_name": device.zone_name}
+
+  def save_topology(self):
+    if self.topology_cache is None:
+      return
+    devices = list(self.devices_list)
+    batch = self.run_all("Describe",
+                         [(d.ip, lambda d=d: self.describe(d))
+                          for d in devices],
+                         STATUS_STEP_DEADLINE)
+    self.topology_cache.save([batch.results.get(d.ip) or {"ip": d.ip}
+                              for d in devices])
+
+  def device_status(self, device):
+    """ Return the status of a device, as shown by the webfrontend.
+    """
+    sonos = device.device
+    group = sonos.group
+    return {"ip": device.ip,
+            "player_name": sonos.player_name,
+            "uid": sonos.uid,
+            "volume": sonos.volume,
+            "group": {"uid": group.uid,
+                      "coordinator_ip": group.coordinator.ip_address,
+                      "members": sorted(member.ip_address
+                                        for member in group.members)}}
+
+  def status(self, max_age=STATUS_MAX_AGE):
+    """ Return the status of the pool, serialized as JSON.
+
+      The devices are read concurrently, and the result is reused for
+      max_age seconds, so the webfrontend gets it in a single round trip.
+    Returns:
+      {"devices": [device_status(), ...], "updated": timestamp,
+       "http": SessionPool.stats()}
+    """
+    with self.status_lock:
+      if self.status_json is not None and \
+         time.time() - self.status_time < max_age:
+        return self.status_json
+
+      devices = list(self.devices_list)
+      batch = self.run_all("Status",
+                           [(d.ip, lambda d=d: self.device_status(d))
+                            for d in devices],
+                           STATUS_STEP_DEADLINE, self.status_executor)
+      unreachable = lambda ip: {"ip": ip, "error": True,
+                                "group": {"members": []}}
+      status = {"devices": [batch.results.get(d.ip) or unreachable(d.ip)
+                            for d in devices],
+                "updated": time.time(),
+                "http": self.http_pool.stats() if self.http_pool else None}
+      self.status_json = json.dumps(status)
+      self.status_time = status["updated"]
+      return self.status_json
+
+  def select_devices(self, zones=None):
+    """ Return the devices of the given zones.
+    Args:
+      zones ([str, ...]): zone names or IP addresses, None for all the
+                          devices.
+    """
+    # The pool may be replaced by a discovery meanwhile, work on a copy.
+    devices = list(self.devices_list)
+    if zones:
+      devices = [d for d in devices if d.ip in zones or d.zone_name in zones]
+    return devices
+
+  def pause_play_bell_resume(self, uri, volume, duration=None, zones=None):
     """ Pause and save state, play uri at the specified volume and resume.
+      Only the devices of the targeted zones are paused, regrouped and
+      resumed, the others keep playing. Targeted zones grouped with zones
+      that are not targeted leave their group for the bell, see
+      detach_devices.
     Args:
       uri (str): uri of the sound to play. Generally the samba share link.
       volume (int): volume at which the sound will be played.
+      duration (float): duration of the sound in seconds, if known.
+      zones ([str, ...]): zone names or IP addresses, None for all the zones.
+    """
+    devices = self.select_devices(zones)
+    if not devices:
+      self.logger.error("No sonos to play %s on (zones %s)." % (uri, zones))
+      return
+    session = self.open_session(zones)
+    timings = {"start": time.time(), "devices": len(devices)}
+    plan = None
+
+    try:
+      # pause all in parallel.
+      self.pause_devices(devices, isolate=bool(zones))
+      timings["paused"] = time.time()
+
+      # Regroup and play
+      plan = self.plan_regroup(devices)
+      self.regroup(plan, volume)
+      timings["regrouped"] = time.time()
+      self.play_session(session, plan, uri, volume, duration)
+      timings["playing"] = session.play_started
+      timings["ended"] = time.time()
+    finally:
+      self.close_session(session)
+
+      # Restore previous groups, unless the bell failed before regrouping.
+      if plan is not None:
+        self.ungroup(plan)
+
+      # Resume all group coordinators
+      self.resume_devices(devices)
+      timings["restored"] = time.time()
+      self.bell_timings.append(timings)
+
+    if self.http_pool is not None:
+      self.logger.info("HTTP : %(requests)s requests, %(reused)s on reused "
+                       "connections." % self.http_pool.stats())
+
+  def open_session(self, zones):
+    session = BellSession(zones)
+    with self.session_lock:
+      self.session = session
+    return session
+
+  def close_session(self, session):
+    """ Stop merging presses into session, its zones are being restored.
+    """
+    with session.lock:
+      session.phase = "restore"
+    with self.session_lock:
+      if self.session is session:
+        self.session = None
+
+  def merge_bell(self, uri, volume, duration=None, zones=None):
+    """ Add a press to the bell in progress, if it targets the same zones.
+    Returns:
+      True if the press was merged, False if it must be played on its own.
+    """
+    if BELL_MERGE_MODE is None:
+      return False
+    with self.session_lock:
+      session = self.session
+    if session is None or session.zones != zones:
+      return False
+    master = None
+    with session.lock:
+      if session.phase == "restore" or \
+         session.plays + (session.pending is None) > BELL_SESSION_MAX_PLAYS:
+        return False
+      session.pending = (uri, volume, duration)
+      if BELL_MERGE_MODE == "restart" and session.phase == "play":
+        session.interrupt.set()
+        master = session.master
+    if BELL_MERGE_MODE == "restart" and master is not None:
+      master.wake()
+    self.logger.info("Merged %s into the bell in progress (%s)." %
+                     (uri, BELL_MERGE_MODE))
+    return True
+
+  def play_session(self, session, plan, uri, volume, duration=None):
+    """ Play the bell, then the presses merged meanwhile.
+    """
+    bell = (uri, volume, duration)
+    while True:
+      with session.lock:
+        # A press during the pause replaces the bell in "restart" mode.
+        if BELL_MERGE_MODE == "restart" and session.pending is not None:
+          bell, session.pending = session.pending, None
+        session.interrupt.clear()
+        session.phase = "play"
+        session.master = plan.master
+        session.plays += 1
+
+      if bell[1] != volume:
+        volume = bell[1]
+        self.set_bell_volume(plan, volume)
+      plan.master.play_bell(bell[0], bell[1], bell[2],
+                            interrupt=session.interrupt,
+                            subscription=plan.subscription)
+      if session.play_started is None:
+        session.play_started = plan.master.play_started
+
+      with session.lock:
+        if session.pending is None:
+          session.phase = "restore"
+          return
+        bell, session.pending = session.pending, None
+
+  def pause_devices(self, devices, isolate=False):
+    """ Save the state of the devices and stop them, fading out if enabled.
+      A device whose pause is cancelled or fails keeps an empty state and is
+      left out of the bell.
+    Args:
+      isolate (bool): take the devices out of the groups they share with
+                      other zones before stopping them, see detach_devices.
+    """
+    for device in devices:
+      device.state = device.State()
+    if not FADE_OUT_ENABLED and not isolate:
+      self.run_all("Pause", [(d.ip, d.pause_sync) for d in devices],
+                   PAUSE_STEP_DEADLINE)
+      return
+
+    self.run_all("Snapshot", [(d.ip, d.snapshot) for d in devices],
+                 PAUSE_STEP_DEADLINE)
+    if isolate:
+      self.detach_devices(devices)
+    saved = [d for d in devices if d.state.group is not None]
+    if FADE_OUT_ENABLED:
+      self.fader.fade([(d, d.state.volume, 0) for d in saved])
+    self.run_all("Stop", [(d.ip, d.stop_sync) for d in saved],
+                 PAUSE_STEP_DEADLINE)
+
+  def detach_devices(self, devices):
+    """ Take the devices out of the groups they share with zones that are
+        not in devices. These zones keep playing and do not hear the bell.
+      The detached devices are moved by the regroup plan, and ungroup()
+      joins them back to their former group.
+    """
+    targeted = set(d.ip for d in devices)
+    detached = []
+    for device in devices:
+      group = device.state.group
+      if group is None:
+        continue
+      others = [member for member in group.members
+                if member.ip_address not in targeted]
+      if not others:
+        continue
+      device.state.detached = True
+      if group.coordinator.ip_address not in targeted:
+        device.state.rejoin = group.coordinator
+      else:
+        device.state.rejoin = others[0]
+      detached.append(device)
+    if not detached:
+      return
+    self.logger.info("Detaching %s zone(s) from their group." % len(detached))
+    self.run_all("Detach", [(d.ip, d.device.unjoin) for d in detached],
+                 PAUSE_STEP_DEADLINE)
+
+  def resume_devices(self, devices):
+    """ Restore the state saved by pause_devices, then fade the volumes in.
     """
-    # pause all in parallel.
-    threads = []
-    for sonos in self.devices_list:
-      t = sonos.pause()
-      threads.append(t)
-      t.start()
-    # Wait for all to pause
-    for t in threads:
-      t.join()
+    saved = [d for d in devices if d.state.group is not None]
+    self.run_all("Resume", [(d.ip, d.resume_sync) for d in saved],
+                 RESUME_STEP_DEADLINE)
+    self.fader.fade([(d, 0, d.state.volume) for d in saved])
 
+  def run_all(self, name, calls, deadline, executor=None):
+    """ Run calls concurrently on the pool executor and wait for them.
+      Calls that did not start before the deadline are cancelled.
+    Args:
+      name (str): step name, for the logs.
+      calls ([(label, callable), ...]): calls to run, labels are device ips.
+      deadline (float): seconds to wait for all the calls.
+      executor (BoundedExecutor): runs the calls instead of the pool executor.
+    Returns:
+      result (BatchResult) : results and errors by device.
+    """
+    batch = run_batch(executor or self.executor, calls, deadline)
+    for label, error in batch.errors.items():
+      self.logger.error("%s failed on %s : %s" % (name, label, error))
+    if batch.timeouts or batch.cancelled:
+      self.logger.error("%s missed the %ss deadline on %s." %
+                        (name, deadline, batch.timeouts + batch.cancelled))
+    self.logger.info("%s done in %.3fs, %s failure(s)." %
+                     (name, batch.duration, batch.failed()))
+    return batch
+
+  def plan_regroup(self, devices):
+    """ Choose the bell master and the zones to move.
+
+      Devices whose state could not be read are left alone. The master is
+      the reachable group coordinator that answered the snapshot fastest,
+      zones already grouped with it are not moved.
+    """
+    members = [d for d in devices if d.state.group is not None]
+    if not members:
+      self.logger.warn("No sonos answered the snapshot, using %s." %
+                       devices[0].ip)
+      master = devices[0]
+      return RegroupPlan(master, list(devices),
+                         [d for d in devices if d is not master], False)
+
+    coordinators = [d for d in members if d.state.is_coordinator] or members
+    master = min(coordinators, key=lambda d: d.state.snapshot_time)
+    master_uid = master.state.group.coordinator.uid
+    moves = [d for d in members if d is not master and
+             (d.state.group.coordinator.uid != master_uid or
+              d.state.detached or not master.state.is_coordinator)]
+    self.logger.info("Bell master : %s, %s zone(s) to move." %
+                     (master.ip, len(moves)))
+    return RegroupPlan(master, members, moves,
+                       master.state.is_coordinator is False)
+
+  def regroup(self, plan, volume):
+    """ Join the zones to the master and set the bell volume everywhere.
+    """
     self.logger.info("Regrouping for bell.")
-    # regroup
-    master = self.devices_list[0]
-    [zone.device.join(master.device) for zone in self.devices_list if zone is not master]
-    # set bell volume everywhere
-    for zone in self.devices_list:
-      zone.device.volume = volume 
-
-    # Bell
-    master.play_bell(uri, volume)
-
-    # Resume
-    # Unjoin all
-    [zone.device.unjoin() for zone in self.devices_list]
-    # Join previous groups
-    for device in self.devices_list:
-      zone = device.device
-      group_coordinator = device.state.group.coordinator
-      if zone is not group_coordinator:
-        zone.join(group_coordinator)
-    # Resume all group coordinators
-    threads = []
-    for device in self.devices_list:
-      zone = device.device
-      t = device.resume()
-      threads.append(t)
-      t.start()
-    # Wait for all to resume
-    for t in threads:
-      t.join()
+
+    # The SUBSCRIBE round trip is done meanwhile, not before the bell.
+    def subscribe():
+      plan.subscription = plan.master.subscribe_events()
+    subscribing = self.executor.submit(subscribe)
+
+    if plan.unjoin_master:
+      plan.master.device.unjoin()
+    self.run_all("Regroup",
+                 [(zone.ip, lambda zone=zone: zone.device.join(plan.master.device))
+                  for zone in plan.moves],
+                 REGROUP_STEP_DEADLINE)
+    self.set_bell_volume(plan, volume)
+    subscribing.wait(REGROUP_STEP_DEADLINE)
+
+  def set_bell_volume(self, plan, volume):
+    def set_volume(zone):
+      zone.device.volume = volume
+    self.run_all("Bell volume",
+                 [(zone.ip, lambda zone=zone: set_volume(zone))
+                  for zone in plan.members],
+                 REGROUP_STEP_DEADLINE)
+
+  def ungroup(self, plan):
+    """ Put the moved zones back in the groups saved by pause_sync.
+    """
+    subscription, plan.subscription = plan.subscription, None
+    if subscription is not None:
+      self.executor.submit(subscription.unsubscribe)
+
+    moved = list(plan.moves)
+    if plan.unjoin_master or plan.master.state.detached:
+      moved.append(plan.master)
+    self.run_all("Unjoin", [(zone.ip, zone.device.unjoin) for zone in moved],
+                 UNGROUP_STEP_DEADLINE)
+
+    def rejoin(device):
+      coordinator = device.state.group.coordinator
+      if device.state.detached:
+        # The zones left behind may have a new coordinator meanwhile.
+        coordinator = read_group(device.state.rejoin).coordinator
+      if coordinator.ip_address != device.ip:
+        device.device.join(coordinator)
+    self.run_all("Rejoin",
+                 [(device.ip, lambda device=device: rejoin(device))
+                  for device in moved if device.state.group is not None],
+                 UNGROUP_STEP_DEADLINE)
+
+  def bell_steps(self, uri, volume, duration=None, zones=None):
+    """ Split pause_play_bell_resume into steps that can be scheduled as tasks.
+
+      Calls of a step are independent and may run concurrently, a step must
+      only be started once the calls of the previous one are finished or
+      cancelled.
+    Returns:
+      [(name, [callable, ...], deadline), ...]
+    """
+    devices = self.select_devices(zones)
+    if not devices:
+      return []
+    # Unset if the step making it failed or was cancelled.
+    bell = {"session": None, "plan": None}
+
+    timings = {"devices": len(devices)}
+
+    def pause():
+      timings["start"] = time.time()
+      bell["session"] = self.open_session(zones)
+      self.pause_devices(devices, isolate=bool(zones))
+      timings["paused"] = time.time()
+
+    def regroup():
+      bell["plan"] = self.plan_regroup(devices)
+      self.regroup(bell["plan"], volume)
+      timings["regrouped"] = time.time()
+
+    def play():
+      if bell["plan"] is None:
+        return
+      try:
+        self.play_session(bell["session"], bell["plan"], uri, volume,
+                          duration)
+        timings["playing"] = bell["session"].play_started
+        timings["ended"] = time.time()
+      finally:
+        self.close_session(bell["session"])
+
+    def ungroup():
+      # The play step may have been cancelled.
+      if bell["session"] is not None:
+        self.close_session(bell["session"])
+      if bell["plan"] is not None:
+        self.ungroup(bell["plan"])
+
+    def resume():
+      self.resume_devices(devices)
+      timings["restored"] = time.time()
+      self.bell_timings.append(timings)
+
+    # Steps made of sub steps get the sum of their deadlines.
+    fade = FADE_DURATION + 10 * FADE_STEP
+    plays = BELL_SESSION_MAX_PLAYS if BELL_MERGE_MODE else 1
+    return [
+      ("pause", [pause], 2 * PAUSE_STEP_DEADLINE + fade),
+      ("regroup", [regroup], 2 * REGROUP_STEP_DEADLINE),
+      ("play", [play], plays * PLAY_STEP_DEADLINE),
+      ("ungroup", [ungroup], 2 * UNGROUP_STEP_DEADLINE),
+      ("resume", [resume], RESUME_STEP_DEADLINE + fade),
+    ]
 
 class SonosDeviceManager():
   """ Handles one sonos device.
@@ -105,66 +713,141 @@ class SonosDeviceManager():
       self.from_queue        = False
       self.volume            = 0
       self.group             = None
+      self.is_coordinator    = None
+      # Taken out of a group shared with zones that are not rung, rejoin is
+      # a zone of that group (SoCo).
+      self.detached          = False
+      self.rejoin            = None
+      # seconds spent reading the state
+      self.snapshot_time     = 0
 
-  def __init__(self, ip, logger=None):
+  def __init__(self, ip, event_listener=None, executor=None, http_pool=None,
+               logger=None):
     self.logger = logger or logging.getLogger(__name__)
 
     self.ip = ip
+    # Zone name, known from the topology cache or a discovery.
+    self.zone_name = None
+    # Set by play_bell, used by wake().
+    self.interrupt = threading.Event()
+    self.subscription = None
+    self.play_started = None
     self.device = soco.SoCo(self.ip)
+    self.event_listener = event_listener
+    self.executor = executor or BoundedExecutor(4, name="sonos-%s" % ip)
+    self.http_pool = http_pool
+
+  def http_stats(self):
+    """ Return the HTTP connection reuse counters of this device.
+    """
+    if self.http_pool is None:
+      return None
+    return self.http_pool.stats("%s:1400" % self.ip)
 
   def pause_sync(self):
     """ Save the current state, and pause if the device is playing.
     """
+    self.snapshot()
+    self.stop_sync()
+
+  def snapshot(self):
+    """ Save the current state.
+    """
     self.state = self.State()
+    start = time.time()
     try:
-      track_info     = self.device.get_current_track_info()
-      transport_info = self.device.get_current_transport_info()
-      queue          = self.device.get_queue()
-
-      self.state.playlist_position = track_info["playlist_position"]
-      self.state.uri               = track_info["uri"]
-      self.state.position          = track_info["position"]
-      self.state.state             = transport_info["current_transport_state"]
-      self.state.volume            = self.device.volume
+      if LIGHTWEIGHT_SNAPSHOT_ENABLED:
+        self.snapshot_lightweight()
+      else:
+        self.snapshot_full()
       self.logger.info("Saving volume : %s." % self.state.volume)
-
-      for QueueItem in queue:
-        if self.state.uri == QueueItem.uri:
-          self.state.from_queue = True
-          break
-
-      self.state.group = self.device.group
     except:
       # Cannot retrieve current state, will return in a STOPPED state
       self.logger.error("Could not get current state.", exc_info=True)
+    self.state.snapshot_time = time.time() - start
+    self.logger.info("Snapshot of %s took %.3fs." % (self.ip,
+                                                     self.state.snapshot_time))
 
-    # Fade out
-    if FADE_OUT_ENABLED:
-      self.logger.info("Fading out.")
-      while self.device.volume != 0:
-        self.device.volume = max(self.device.volume - 5, 0)
-        time.sleep(0.100)
-      self.logger.info("Fading out complete.")
-
-    if not self.device.is_coordinator:
-      self.device.unjoin()
-      self.logger.info("Unjoined.")
-
-    # Stop
+  def stop_sync(self):
+    """ Stop the device if it is playing.
+      Group members are stopped with their coordinator and stay in their
+      group, the regroup plan only moves the zones it has to.
+    """
+    if self.state.is_coordinator is False:
+      return
     if self.state.state not in ["PAUSED_PLAYBACK", "STOPPED"]:
       try:
         self.device.stop()
       except:
         self.logger.error("Could not stop.", exc_info=True)
 
-  def resume_sync(self):
+  def snapshot_full(self):
+    """ Save the current state, the queue is downloaded to know if the
+        current track is played from it.
+    """
+    track_info     = self.device.get_current_track_info()
+    transport_info = self.device.get_current_transport_info()
+    queue          = self.device.get_queue()
+
+    self.state.playlist_position = track_info["playlist_position"]
+    self.state.uri               = track_info["uri"]
+    self.state.position          = track_info["position"]
+    self.state.state             = transport_info["current_transport_state"]
+    self.state.volume            = self.device.volume
+
+    for QueueItem in queue:
+      if self.state.uri == QueueItem.uri:
+        self.state.from_queue = True
+        break
+
+    self.state.group = self.read_group()
+    self.state.is_coordinator = \
+      self.state.group.coordinator.ip_address == self.ip
+
+  def read_group(self):
+    """ Return the group of the device, read from the speaker.
+    """
+    return read_group(self.device)
+
+  def snapshot_lightweight(self):
+    """ Save the current state with concurrent reads.
+        The track is played from the queue when the transport URI is the
+        queue of the device (x-rincon-queue:...), the queue is not read.
+    """
+    submit = self.executor.submit
+    track_info     = submit(self.device.get_current_track_info)
+    transport_info = submit(self.device.get_current_transport_info)
+    media_info     = submit(self.device.avTransport.GetMediaInfo,
+                            [("InstanceID", 0)])
+    volume         = submit(lambda: self.device.volume)
+    group          = submit(self.read_group)
+
+    track_info = track_info.result()
+    self.state.playlist_position = track_info["playlist_position"]
+    self.state.uri               = track_info["uri"]
+    self.state.position          = track_info["position"]
+    self.state.state             = \
+      transport_info.result()["current_transport_state"]
+    self.state.from_queue        = \
+      media_info.result()["CurrentURI"].startswith("x-rincon-queue:")
+    self.state.volume            = volume.result()
+    self.state.group             = group.result()
+    self.state.is_coordinator    = \
+      self.state.group.coordinator.ip_address == self.ip
+
+  def resume_sync(self, fade_in=True):
     """ Restore the previous state and resume playing if needed.
+    Args:
+      fade_in (bool): leave the volume at 0, the caller fades it in (see
+                      SonosPoolManager.resume_devices). Otherwise the saved
+                      volume is restored at once.
     """
     # Prepare for fade in
     self.device.volume = 0
 
-    # Resume playing if coordiantor
-    if self.device.is_coordinator:
+    # Resume playing if coordiantor, the music of a detached zone went on
+    # in the group it joined back.
+    if not self.state.detached and self.device.is_coordinator:
       try:
         if self.state.from_queue:
           self.device.play_from_queue(int(self.state.playlist_position)-1)
@@ -189,54 +872,162 @@ class SonosDeviceManager():
           self.logger.error("Could not restore PAUSED_PLAYBACK state",
                             exc_info=True)
 
-    # Fade in, all
-    self.logger.info("Restoring volume to %s. Fading in." % self.state.volume)
-    while self.device.volume != self.state.volume:
-      self.device.volume = min(self.device.volume + 5, self.state.volume)
-      time.sleep(0.100)
-    self.logger.info("Fade in complete.")
+    if not fade_in:
+      self.logger.info("Restoring volume to %s." % self.state.volume)
+      self.device.volume = self.state.volume
 
-  def play_bell(self, uri, volume):
+  def subscribe_events(self):
+    """ Subscribe to the AVTransport events of the device.
+    Returns:
+      subscription (Subscription) : None if there is no event listener or
+                                    the subscription failed.
+    """
+    if self.event_listener is None:
+      return None
+    try:
+      return self.event_listener.subscribe(self.ip)
+    except:
+      self.logger.warn("Could not subscribe to %s events, polling." % self.ip,
+                       exc_info=True)
+      return None
+
+  def play_bell(self, uri, volume, duration=None, interrupt=None,
+                subscription=None):
     """ Play a sound from a given uri and volume.
-        This function is blocking and will poll each second or so until
-        the sound has finished playing.
+        This function is blocking until the sound has finished playing.
+        The end is detected with AVTransport events when an event listener
+        is available, by polling otherwise. When the duration is known, the
+        status is only checked once the sound should be over.
     Args:
       uri (str): uri of the sound to play. Generally the samba share link.
       volume (int): volume at which the sound will be played.
+      duration (float): duration of the sound in seconds, if known.
+      interrupt (threading.Event): stop waiting once set, see wake().
+      subscription (Subscription): events of the device, subscribed by the
+                                   caller who also unsubscribes it. Without
+                                   it, play_bell subscribes for this sound.
     """
+    self.interrupt = interrupt or threading.Event()
+    owned = subscription is None
+    if owned:
+      subscription = self.subscribe_events()
+    else:
+      # Forget the events of the previous sound played with it.
+      subscription.clear()
+    self.subscription = subscription
+
     try:
       self.logger.info("Bell : URI %s, Volume : %s." % (uri, volume))
       self.device.volume = volume
       self.device.play_uri(uri)
-      time.sleep(1)  # sometimes it takes some time for the sonos to start.
-      # Wait for completion : Polling each 1 second
-      while True:
-        time.sleep(1)
-
-        try:
-          track_info   = self.device.get_current_track_info()
-          transport_info = self.device.get_current_transport_info()
-        except:
-          self.logger.error("Could not retrieve status while playing %s" % uri,
-                            exc_info=True)
-          break
-
-        # Prevent a lock in case the device stopped playing.
-        if uri not in track_info["uri"]:
-          self.logger.info("URI %s is not playing." % uri)
-          break
-        if "PLAYING" not in transport_info["current_transport_state"]:
-          self.logger.info("URI %s is not playing." % uri)
-          break
+      self.play_started = time.time()
+      if subscription is None or \
+         not self.wait_bell_end(subscription, uri, duration):
+        self.poll_bell_end(uri, duration)
     except:
       self.logger.error("An unexpected problem occurred while playing %s" % uri,
                         exc_info=True)
+    finally:
+      self.subscription = None
+      if owned and subscription is not None:
+        subscription.unsubscribe()
+
+  def wake(self):
+    """ Make play_bell return early, once its interrupt event is set.
+    """
+    subscription = self.subscription
+    if subscription is not None:
+      subscription.notify({})
+
+  def sleep(self, seconds):
+    """ Sleep while playing a bell.
+    Returns:
+      True if the bell was interrupted.
+    """
+    return self.interrupt.wait(seconds) or self.interrupt.is_set()
+
+  def is_playing(self, uri):
+    """ Return True if the device is still playing uri.
+    """
+    try:
+      track_info   = self.device.get_current_track_info()
+      transport_info = self.device.get_current_transport_info()
+    except:
+      self.logger.error("Could not retrieve status while playing %s" % uri,
+                        exc_info=True)
+      return False
+
+    # Prevent a lock in case the device stopped playing.
+    if uri not in track_info["uri"]:
+      self.logger.info("URI %s is not playing." % uri)
+      return False
+    if "PLAYING" not in transport_info["current_transport_state"]:
+      self.logger.info("URI %s is not playing." % uri)
+      return False
+    return True
+
+  def wait_bell_end(self, subscription, uri, duration=None):
+    """ Wait for the bell to stop using AVTransport events.
+        The status is polled once in a while as a safety net.
+    Returns:
+      True when the end was detected, False if the events are not usable.
+    """
+    def playing(variables):
+      return self.interrupt.is_set() or \
+             (variables.get("TransportState") == "PLAYING" and
+              uri in variables.get("CurrentTrackURI", uri))
+
+    def stopped(variables):
+      return self.interrupt.is_set() or \
+             (not playing(variables) and
+              variables.get("TransportState") != "TRANSITIONING")
+
+    if not subscription.wait_for(playing, EVENT_START_TIMEOUT):
+      self.logger.warn("No PLAYING event from %s, polling." % self.ip)
+      return False
+
+    timeout = EVENT_SAFETY_POLL
+    if duration:
+      timeout = duration + BELL_END_MARGIN
+    while not subscription.wait_for(stopped, timeout):
+      timeout = EVENT_SAFETY_POLL
+      if self.interrupt.is_set() or not self.is_playing(uri):
+        self.logger.warn("Missed the end of %s event." % uri)
+        break
+    self.logger.info("URI %s is not playing." % uri)
+    return True
+
+  def poll_bell_end(self, uri, duration=None):
+    """ Wait for the bell to stop by polling each second or so, or from its
+        expected end when the duration is known.
+    """
+    if duration:
+      if self.sleep(duration + BELL_END_MARGIN):
+        return
+      while self.is_playing(uri):
+        if self.sleep(BELL_END_MARGIN):
+          return
+      return
+
+    # sometimes it takes some time for the sonos to start.
+    if self.sleep(1):
+      return
+    # Wait for completion : Polling each 1 second
+    while True:
+      if self.sleep(1):
+        return
+      if not self.is_playing(uri):
+        break
 
   def resume(self):
-    """ Call resume_sync in a separate thread to make it async.
+    """ Call resume_sync in the executor to make it async.
+    Returns:
+      future (Future)
     """
-    return FuncThread(self.resume_sync)
+    return self.executor.submit(self.resume_sync, False)
   def pause(self):
-    """ Call pause_sync in a separate thread to make it async.
+    """ Call pause_sync in the executor to make it async.
+    Returns:
+      future (Future)
     """
-    return FuncThread(self.pause_sync)
+    return self.executor.submit(self.pause_sync)
@@ -0,0 +1,46 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import json
+
+from utils.file_utils import write_file
+
+import logging
+
+class TopologyCache():
+  """ Stores the last known Sonos topology in a JSON file.
+
+    Each entry describes one zone :
+      {"ip": "192.168.0.10", "uid": "RINCON_...", "zone_name": "Kitchen"}
+    The groups are not cached, they are read from the zones for each bell.
+  """
+  def __init__(self, filename, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.filename = filename
+
+  def load(self):
+    """ Return the cached entries, [] if there is no usable cache.
+    """
+    try:
+      with open(self.filename) as f:
+        entries = json.load(f)["zones"]
+      return [entry for entry in entries if entry.get("ip")]
+    except IOError:
+      return []
+    except:
+      self.logger.error("Could not read topology cache %s." % self.filename,
+                        exc_info=True)
+      return []
+
+  def save(self, entries):
+    """ Replace the cached entries, atomically.
+    """
+    try:
+      write_file(self.filename,
+                 json.dumps({"version": 1, "zones": entries}, indent=2))
+    except:
+      self.logger.error("Could not write topology cache %s." % self.filename,
+                        exc_info=True)
@@ -0,0 +1,109 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import heapq
+import itertools
+import threading
+
+import logging
+
+PRIORITY_HIGH   = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2
+
+class DispatchQueue():
+  """ Bounded priority queue used between the UDP receiver and the workers.
+
+    put() never blocks : the receiver must stay responsive whatever the
+    speakers are doing.
+
+    Items are ordered by priority (lower value first), then by arrival order.
+    An item whose key is already waiting in the queue is collapsed into the
+    waiting one (repeated presses on the same button). When the queue is
+    full, the new item replaces the least important waiting item if it has
+    a higher priority, otherwise it is dropped.
+
+    Counters are kept in self.stats : queued, collapsed, dropped, processed.
+  """
+  def __init__(self, maxsize=8, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.maxsize = maxsize
+    self._heap = []
+    self._keys = {}
+    self._counter = itertools.count()
+    self._not_empty = threading.Condition(threading.Lock())
+
+    self.stats = {"queued": 0, "collapsed": 0, "dropped": 0, "processed": 0}
+
+  def __len__(self):
+    with self._not_empty:
+      return len(self._heap)
+
+  def put(self, item, key=None, priority=PRIORITY_NORMAL):
+    """ Add an item to the queue, without blocking.
+    Args:
+      item: the object handed to the consumer.
+      key: items with the same key are collapsed while waiting. None disables.
+      priority (int): PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.
+    Returns:
+      True if the item was queued, False if it was collapsed or dropped.
+    """
+    with self._not_empty:
+      if key is not None and key in self._keys:
+        self.stats["collapsed"] += 1
+        return False
+
+      if len(self._heap) >= self.maxsize:
+        victim = max(self._heap)
+        if priority >= victim[0]:
+          self.stats["dropped"] += 1
+          self.logger.warn("Dispatch queue full, dropping item (key %s)." % key)
+          return False
+        self._heap.remove(victim)
+        heapq.heapify(self._heap)
+        self._keys.pop(victim[2], None)
+        self.stats["dropped"] += 1
+        self.logger.warn("Dispatch queue full, evicted item (key %s)."
+                         % victim[2])
+
+      heapq.heappush(self._heap, (priority, next(self._counter), key, item))
+      if key is not None:
+        self._keys[key] = True
+      self.stats["queued"] += 1
+      self._not_empty.notify()
+      return True
+
+  def get(self, timeout=None):
+    """ Remove and return the most important item.
+    Args:
+      timeout (float): seconds to wait for an item, None waits forever.
+    Returns:
+      the item, or None if the timeout expired.
+    """
+    with self._not_empty:
+      if timeout is None:
+        while not self._heap:
+          self._not_empty.wait()
+      elif not self._heap:
+        self._not_empty.wait(timeout)
+        if not self._heap:
+          return None
+      return self._pop()
+
+  def get_nowait(self):
+    """ Remove and return the most important item, None if the queue is empty.
+    """
+    with self._not_empty:
+      if not self._heap:
+        return None
+      return self._pop()
+
+  def _pop(self):
+    priority, _, key, item = heapq.heappop(self._heap)
+    if key is not None:
+      self._keys.pop(key, None)
+    self.stats["processed"] += 1
+    return item
@@ -0,0 +1,237 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import sys
+import time
+import threading
+from Queue import Queue
+
+import logging
+
+class CancelledError(Exception):
+  pass
+
+class Future():
+  """ Result of a call submitted to a BoundedExecutor.
+
+    If result() is called without timeout while the call is still waiting
+    for a worker, the caller runs it itself. This keeps nested submissions
+    (a task waiting for sub tasks on the same executor) from deadlocking a
+    bounded pool.
+  """
+  PENDING   = "PENDING"
+  RUNNING   = "RUNNING"
+  FINISHED  = "FINISHED"
+  CANCELLED = "CANCELLED"
+
+  def __init__(self, fn, args=(), kwargs=None):
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs or {}
+
+    self.state = self.PENDING
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+    self._lock = threading.Lock()
+    self._done = threading.Event()
+
+  def _claim(self):
+    with self._lock:
+      if self.state != self.PENDING:
+        return False
+      self.state = self.RUNNING
+      return True
+
+  def run(self):
+    """ Execute the call, unless somebody already did.
+    """
+    if self._claim():
+      self._execute()
+
+  def _execute(self):
+    try:
+      self._result = self.fn(*self.args, **self.kwargs)
+    except:
+      self._exc_info = sys.exc_info()
+    with self._lock:
+      self.state = self.FINISHED
+      callbacks, self._callbacks = self._callbacks, []
+    self._done.set()
+    for callback in callbacks:
+      self._invoke(callback)
+
+  def cancel(self):
+    """ Cancel the call if it did not start yet.
+    Returns:
+      True if the call is cancelled.
+    """
+    with self._lock:
+      if self.state == self.CANCELLED:
+        return True
+      if self.state != self.PENDING:
+        return False
+      self.state = self.CANCELLED
+      callbacks, self._callbacks = self._callbacks, []
+    self._done.set()
+    for callback in callbacks:
+      self._invoke(callback)
+    return True
+
+  def cancelled(self):
+    return self.state == self.CANCELLED
+
+  def _invoke(self, callback):
+    try:
+      callback(self)
+    except:
+      logging.getLogger(__name__).error("In future callback : ", exc_info=True)
+
+  def done(self):
+    return self.state in (self.FINISHED, self.CANCELLED)
+
+  def wait(self, timeout=None):
+    """ Wait for the call to finish or be cancelled.
+      Without timeout, a call still waiting for a worker is run inline.
+    Returns:
+      True if it is done, False if the timeout expired.
+    """
+    if timeout is None and self._claim():
+      self._execute()
+    return self._done.wait(timeout)
+
+  def result(self, timeout=None):
+    """ Return the value returned by the call, or raise its exception.
+    Args:
+      timeout (float): seconds to wait, None waits forever.
+    """
+    if not self.wait(timeout):
+      raise RuntimeError("Timeout while waiting for %s." % self.fn)
+    if self.state == self.CANCELLED:
+      raise CancelledError()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    """ Return the exception raised by the call, None if it succeeded.
+    """
+    if not self.wait(timeout):
+      raise RuntimeError("Timeout while waiting for %s." % self.fn)
+    if self.state == self.CANCELLED:
+      return CancelledError()
+    if self._exc_info:
+      return self._exc_info[1]
+    return None
+
+  def add_done_callback(self, callback):
+    """ Call callback(future) once finished, immediately if already done.
+    """
+    with self._lock:
+      if self.state not in (self.FINISHED, self.CANCELLED):
+        self._callbacks.append(callback)
+        return
+    self._invoke(callback)
+
+class BoundedExecutor():
+  """ A fixed number of long lived worker threads fed by a bounded queue.
+
+    Used to run blocking calls (Sonos SOAP requests) without creating one
+    thread per call. Workers are started lazily, up to max_workers.
+  """
+  def __init__(self, max_workers=4, max_queue=0, name="executor",
+               logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.max_workers = max_workers
+    self.name = name
+    self._queue = Queue(max_queue)
+    self._workers = []
+    self._lock = threading.Lock()
+    self._shutdown = False
+
+  def submit(self, fn, *args, **kwargs):
+    """ Schedule fn(*args, **kwargs) and return its Future.
+      Blocks if the queue is full.
+    """
+    if self._shutdown:
+      raise RuntimeError("%s is shut down." % self.name)
+    future = Future(fn, args, kwargs)
+    self._queue.put(future)
+    self._ensure_workers()
+    return future
+
+  def _ensure_workers(self):
+    with self._lock:
+      if len(self._workers) < self.max_workers:
+        worker = threading.Thread(target=self._work,
+                                  name="%s-%s" % (self.name,
+                                                  len(self._workers)))
+        worker.setDaemon(True)
+        self._workers.append(worker)
+        worker.start()
+
+  def _work(self):
+    while True:
+      future = self._queue.get()
+      if future is None:
+        return
+      future.run()
+
+  def shutdown(self):
+    """ Stop the workers once the queued calls are done.
+    """
+    self._shutdown = True
+    with self._lock:
+      for _ in self._workers:
+        self._queue.put(None)
+      self._workers = []
+
+class BatchResult():
+  """ Outcome of run_batch : results and errors by label.
+  """
+  def __init__(self):
+    self.results = {}
+    # label: exception raised by the call
+    self.errors = {}
+    # labels of the calls still running when the timeout expired
+    self.timeouts = []
+    # labels of the calls cancelled before they started
+    self.cancelled = []
+    self.duration = 0
+
+  def failed(self):
+    return len(self.errors) + len(self.timeouts) + len(self.cancelled)
+
+def run_batch(executor, calls, timeout=None):
+  """ Run calls concurrently and wait for them.
+  Args:
+    executor (BoundedExecutor): executor running the calls.
+    calls ([(label, callable), ...]): calls to run.
+    timeout (float): seconds to wait for the batch, None waits forever.
+      Calls that did not start when it expires are cancelled.
+  Returns:
+    result (BatchResult)
+  """
+  start = time.time()
+  batch = BatchResult()
+  futures = [(label, executor.submit(call)) for label, call in calls]
+  for label, future in futures:
+    remaining = None
+    if timeout is not None:
+      remaining = max(0, start + timeout - time.time())
+    if not future.wait(remaining):
+      if future.cancel():
+        batch.cancelled.append(label)
+      else:
+        batch.timeouts.append(label)
+    elif future.cancelled():
+      batch.cancelled.append(label)
+    elif future.exception() is not None:
+      batch.errors[label] = future.exception()
+    else:
+      batch.results[label] = future.result()
+  batch.duration = time.time() - start
+  return batch
@@ -0,0 +1,112 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import logging
+
+class Feature():
+  """ A lextend feature, as seen by the packet parser.
+  """
+  def __init__(self, name, header_getter, parser, handler=None):
+    """
+    Args:
+      name (str): feature name, reported as "type" by parse().
+      header_getter (callable): header_getter(cfg) returns the configured
+                                header, or a list of headers. A header may
+                                be given as (header, context), context is
+                                a dict of keyword arguments for handler.
+      parser (callable): parser(args) returns the parameters decoded from
+                         the bytes following the header, None if invalid.
+      handler (callable): handler(params, **context) called by dispatch().
+    """
+    self.name = name
+    self.header_getter = header_getter
+    self.parser = parser
+    self.handler = handler
+
+class FeatureRegistry():
+  """ Maps packet headers to features.
+
+    Packet format: HEADER + ARGS (see protocol.txt).
+
+    compile() builds a character trie from the configured headers, so that
+    finding the feature of a packet only depends on the header length, not
+    on the number of features. compile() must be called again whenever the
+    configuration is reloaded; the new trie replaces the old one at once.
+  """
+  def __init__(self, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.features = []
+    self._trie = {}
+
+  def register(self, name, header_getter, parser, handler=None):
+    self.features.append(Feature(name, header_getter, parser, handler))
+
+  def compile(self, cfg):
+    """ Build the header trie from the configuration.
+    """
+    trie = {}
+    for feature in self.features:
+      headers = feature.header_getter(cfg)
+      if isinstance(headers, basestring):
+        headers = [headers]
+      for header in headers:
+        context = {}
+        if isinstance(header, tuple):
+          header, context = header
+        if not header:
+          self.logger.error("Empty header for feature %s." % feature.name)
+          continue
+        node = trie
+        for c in header:
+          node = node.setdefault(c, {})
+        if None in node:
+          self.logger.error("Header %s used by %s and %s." %
+                            (header, node[None][0].name, feature.name))
+          continue
+        node[None] = (feature, header, context)
+    self._trie = trie
+
+  def match(self, data):
+    """ Find the feature with the longest header matching data.
+    Returns:
+      (feature, header, context) if found, (None, None, None) otherwise.
+    """
+    node = self._trie
+    found = (None, None, None)
+    for c in data:
+      node = node.get(c)
+      if node is None:
+        break
+      if None in node:
+        found = node[None]
+    return found
+
+  def parse(self, data):
+    """ Parse a packet.
+    Returns:
+      {"type":"", "params":(parameters)} if successful, None otherwise.
+    """
+    feature, header, context = self.match(data)
+    if feature is None:
+      return None
+    try:
+      params = feature.parser(data[len(header):])
+    except:
+      return None
+    if params is None:
+      return None
+    return {"type": feature.name, "params": params, "feature": feature,
+            "context": context}
+
+  def dispatch(self, data):
+    """ Parse a packet and hand its parameters to the feature handler.
+    Returns:
+      the parse() result, None if the packet could not be decoded.
+    """
+    ret = self.parse(data)
+    if ret and ret["feature"].handler:
+      ret["feature"].handler(ret["params"], **ret["context"])
+    return ret
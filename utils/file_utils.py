@@ -0,0 +1,32 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import os
+import tempfile
+
+def temp_path(path):
+  """ Return a new hidden file name next to path, unique to this call.
+    The engine and the webfrontend may write the same file at once, each
+    one writes its own temporary file before renaming it over path.
+  """
+  folder, name = os.path.split(path)
+  fd, tmp = tempfile.mkstemp(dir=folder, prefix="." + name + ".",
+                             suffix=".tmp")
+  os.close(fd)
+  return tmp
+
+def write_file(path, data):
+  """ Replace the content of path atomically.
+  """
+  tmp = temp_path(path)
+  try:
+    # mkstemp creates the file for its owner only.
+    os.chmod(tmp, 0644)
+    with open(tmp, "w") as f:
+      f.write(data)
+    os.rename(tmp, path)
+  except:
+    os.remove(tmp)
+    raise
@@ -0,0 +1,157 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import os
+import struct
+
+# Bitrates in kbps, by [version][layer][index]. Version 1 is MPEG1, 2 is MPEG2
+# and MPEG2.5.
+BITRATES = {
+  1: {1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+      2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+      3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]},
+  2: {1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+      2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+      3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]},
+}
+
+# Sample rates in Hz, by version bits.
+SAMPLE_RATES = {
+  3: [44100, 48000, 32000],   # MPEG1
+  2: [22050, 24000, 16000],   # MPEG2
+  0: [11025, 12000, 8000],    # MPEG2.5
+}
+
+VERSION_NAMES = {3: "MPEG1", 2: "MPEG2", 0: "MPEG2.5"}
+
+# Bytes read from the beginning of a file to find the first frame.
+PROBE_SIZE = 64 * 1024
+
+def id3v2_size(data):
+  """ Return the size of the ID3v2 tag at the beginning of data, 0 if none.
+  """
+  if len(data) < 10 or data[:3] != "ID3":
+    return 0
+  b = [ord(c) for c in data[6:10]]
+  size = (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+  footer = 10 if ord(data[5]) & 0x10 else 0
+  return 10 + size + footer
+
+def parse_frame_header(data, offset=0):
+  """ Decode the 4 bytes MPEG audio frame header at offset.
+  Returns:
+    dict with version, layer, bitrate (kbps), sample_rate, samples, length
+    (bytes of the frame), mono; None if it is not a valid header.
+  """
+  if len(data) < offset + 4:
+    return None
+  h = struct.unpack(">I", data[offset:offset + 4])[0]
+  if (h >> 21) & 0x7FF != 0x7FF:
+    return None
+  version_bits = (h >> 19) & 3
+  layer_bits = (h >> 17) & 3
+  bitrate_index = (h >> 12) & 0xF
+  sample_rate_index = (h >> 10) & 3
+  padding = (h >> 9) & 1
+  channel_mode = (h >> 6) & 3
+  if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or \
+     sample_rate_index == 3:
+    return None
+
+  version = 1 if version_bits == 3 else 2
+  layer = 4 - layer_bits
+  bitrate = BITRATES[version][layer][bitrate_index]
+  sample_rate = SAMPLE_RATES[version_bits][sample_rate_index]
+  if layer == 1:
+    samples = 384
+    length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+  else:
+    samples = 1152 if (layer == 2 or version == 1) else 576
+    length = samples // 8 * bitrate * 1000 // sample_rate + padding
+
+  return {"version": VERSION_NAMES[version_bits],
+          "layer": layer,
+          "bitrate": bitrate,
+          "sample_rate": sample_rate,
+          "samples": samples,
+          "length": length,
+          "mono": channel_mode == 3,
+          "mpeg1": version == 1}
+
+def find_first_frame(data, start=0):
+  """ Find the first frame header followed by another valid frame header.
+  Returns:
+    (offset, header) or (None, None).
+  """
+  offset = data.find("\xff", start)
+  while offset != -1 and offset + 4 <= len(data):
+    header = parse_frame_header(data, offset)
+    if header:
+      following = offset + header["length"]
+      # Accept a lone frame at the very end of the probed data.
+      if following + 4 > len(data) or parse_frame_header(data, following):
+        return offset, header
+    offset = data.find("\xff", offset + 1)
+  return None, None
+
+def vbr_frames(data, offset, header):
+  """ Return the frame count of a Xing/Info or VBRI header, None if absent.
+  """
+  if header["mpeg1"]:
+    side_info = 17 if header["mono"] else 32
+  else:
+    side_info = 9 if header["mono"] else 17
+  xing = offset + 4 + side_info
+  tag = data[xing:xing + 4]
+  if tag in ("Xing", "Info") and len(data) >= xing + 12:
+    flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+    if flags & 1:
+      return struct.unpack(">I", data[xing + 8:xing + 12])[0], tag == "Xing"
+  vbri = offset + 4 + 32
+  if data[vbri:vbri + 4] == "VBRI" and len(data) >= vbri + 18:
+    return struct.unpack(">I", data[vbri + 14:vbri + 18])[0], True
+  return None, False
+
+def mp3_info(path):
+  """ Read the duration and format of an MP3 file from its frame headers.
+  Returns:
+    {"duration": seconds, "bitrate": kbps, "sample_rate": Hz,
+     "format": "MPEG1 Layer 3", "vbr": bool}, None if it is not an MP3 file.
+  """
+  size = os.path.getsize(path)
+  with open(path, "rb") as f:
+    data = f.read(PROBE_SIZE)
+    tag_size = id3v2_size(data)
+    if tag_size > len(data) - 4:
+      f.seek(tag_size)
+      data = f.read(PROBE_SIZE)
+      base, start = tag_size, 0
+    else:
+      base, start = 0, tag_size
+
+  offset, header = find_first_frame(data, start)
+  if header is None:
+    return None
+
+  frames, vbr = vbr_frames(data, offset, header)
+  audio_size = size - base - offset
+  if size >= 128:
+    with open(path, "rb") as f:
+      f.seek(-128, os.SEEK_END)
+      if f.read(3) == "TAG":
+        audio_size -= 128
+
+  if frames:
+    duration = float(frames) * header["samples"] / header["sample_rate"]
+    bitrate = int(round(audio_size * 8 / duration / 1000)) if duration else 0
+  else:
+    bitrate = header["bitrate"]
+    duration = audio_size * 8.0 / (bitrate * 1000)
+
+  return {"duration": round(duration, 3),
+          "bitrate": bitrate,
+          "sample_rate": header["sample_rate"],
+          "format": "%s Layer %s" % (header["version"], header["layer"]),
+          "vbr": vbr}
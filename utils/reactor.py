@@ -0,0 +1,133 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import os
+import errno
+import heapq
+import itertools
+import select
+import threading
+import time
+
+import logging
+
+class TimerHandle():
+  """ Returned by Reactor.call_later, used to cancel a scheduled call.
+  """
+  def __init__(self, when, callback, args):
+    self.when = when
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+class Reactor():
+  """ Minimal single threaded event loop based on select().
+
+    Sockets are watched with add_reader(), delayed calls are kept in a heap
+    ordered by deadline. Blocking work is handed to an executor with
+    run_in_executor() and its completion is delivered back to the loop
+    thread, so callbacks never need locks.
+  """
+  def __init__(self, executor=None, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.executor = executor
+    self._readers = {}
+    self._timers = []
+    self._counter = itertools.count()
+    self._pending = []
+    self._pending_lock = threading.Lock()
+    self._running = False
+
+    # Self pipe, used to wake up select() from other threads.
+    self._wakeup_r, self._wakeup_w = os.pipe()
+
+  def add_reader(self, fd, callback, *args):
+    """ Call callback(*args) from the loop whenever fd is readable.
+    """
+    self._readers[fd] = (callback, args)
+
+  def remove_reader(self, fd):
+    self._readers.pop(fd, None)
+
+  def call_later(self, delay, callback, *args):
+    """ Call callback(*args) from the loop after delay seconds.
+    Returns:
+      handle (TimerHandle) : can be used to cancel the call.
+    """
+    handle = TimerHandle(time.time() + delay, callback, args)
+    heapq.heappush(self._timers, (handle.when, next(self._counter), handle))
+    return handle
+
+  def call_soon_threadsafe(self, callback, *args):
+    """ Call callback(*args) from the loop. Can be used from any thread.
+    """
+    with self._pending_lock:
+      self._pending.append((callback, args))
+    try:
+      os.write(self._wakeup_w, "x")
+    except OSError:
+      pass
+
+  def run_in_executor(self, callback, fn, *args):
+    """ Run fn(*args) in the executor then call callback(future) from the loop.
+    Returns:
+      future (Future) : the submitted call.
+    """
+    future = self.executor.submit(fn, *args)
+    future.add_done_callback(
+      lambda f: self.call_soon_threadsafe(callback, f))
+    return future
+
+  def stop(self):
+    self.call_soon_threadsafe(self._stop)
+
+  def _stop(self):
+    self._running = False
+
+  def run_forever(self):
+    self._running = True
+    while self._running:
+      timeout = None
+      while self._timers and self._timers[0][2].cancelled:
+        heapq.heappop(self._timers)
+      if self._timers:
+        timeout = max(0, self._timers[0][0] - time.time())
+
+      fds = list(self._readers.keys()) + [self._wakeup_r]
+      try:
+        readable, _, _ = select.select(fds, [], [], timeout)
+      except select.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd in readable:
+        if fd == self._wakeup_r:
+          os.read(self._wakeup_r, 4096)
+          continue
+        if fd in self._readers:
+          callback, args = self._readers[fd]
+          self._run(callback, args)
+
+      with self._pending_lock:
+        pending, self._pending = self._pending, []
+      for callback, args in pending:
+        self._run(callback, args)
+
+      now = time.time()
+      while self._timers and self._timers[0][0] <= now:
+        _, _, handle = heapq.heappop(self._timers)
+        if not handle.cancelled:
+          self._run(handle.callback, handle.args)
+
+  def _run(self, callback, args):
+    try:
+      callback(*args)
+    except:
+      self.logger.error("In reactor callback : ", exc_info=True)
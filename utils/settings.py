@@ -12,9 +12,32 @@ DEBUG_ENABLE_EMPTY_AUTH    = False
 FLASK_MAX_UPLOAD_SIZE      = 16 * 1024 * 1024
 FLASK_DEBUG                = False
 FLASK_USE_RELOADER         = False
+# seconds the engine status shown by the pages is reused before it is fetched
+# again, only while pages are viewed
+STATUS_CACHE_TTL           = 10
 
 # sonos config
 UDP_PORT                   = 5050
 
-RPC_IP                     = "0.0.0.0"
+RPC_IP                     = "127.0.0.1"
 RPC_PORT                   = 2882
+
+# HTTP server the speakers fetch the bell sounds from, instead of the
+# sonos_share CIFS share
+SOUND_SERVER_ENABLED       = True
+SOUND_SERVER_PORT          = 8080
+
+# seconds between two checks of the local IP address, the bell URIs are
+# rebuilt when it changes
+IP_CHECK_INTERVAL          = 30
+
+# last known sonos topology, in the configuration directory
+SONOS_TOPOLOGY_FILENAME    = "sonos_topology.json"
+
+# bell dispatch
+BELL_QUEUE_SIZE            = 8
+
+# engine mode : "threaded" (one blocking thread per task) or "reactor"
+# (single select() loop, blocking Sonos calls run in a bounded executor)
+ENGINE_MODE                = "threaded"
+SONOS_EXECUTOR_WORKERS     = 4
@@ -0,0 +1,209 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import os
+import mmap
+import mimetypes
+import re
+import socket
+import threading
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+import logging
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Sub folders of the sounds folder holding the sounds, nothing else is served.
+SOUND_FOLDERS = ("defaults", "uploads")
+
+mimetypes.add_type("audio/mpeg", ".mp3")
+
+def parse_range(header, size):
+  """ Parse a single range Range header.
+  Returns:
+    (start, end) inclusive, None if there is no usable range, False if the
+    range can not be satisfied.
+  """
+  if not header:
+    return None
+  match = RANGE_RE.match(header.strip())
+  if not match:
+    return None
+  first, last = match.groups()
+  if first == "" and last == "":
+    return None
+  if first == "":
+    # suffix range : the last N bytes
+    length = int(last)
+    if length == 0:
+      return False
+    return (max(0, size - length), size - 1)
+  start = int(first)
+  end = size - 1 if last == "" else min(int(last), size - 1)
+  if start >= size or start > end:
+    return False
+  return (start, end)
+
+class SoundRequestHandler(BaseHTTPRequestHandler):
+  """ Serves the files of server.root with Range, ETag and cache headers.
+  """
+  protocol_version = "HTTP/1.1"
+
+  def do_HEAD(self):
+    self.serve(send_body=False)
+
+  def do_GET(self):
+    self.serve(send_body=True)
+
+  def translate_path(self):
+    """ Return the path of the requested sound, None if it is not one.
+      Only the audio files of SOUND_FOLDERS are served : not the metadata,
+      the manifest, or the hidden temporary files of uploads and syncs.
+    """
+    path = urllib.unquote(self.path.split("?", 1)[0])
+    parts = path.lstrip("/").split("/")
+    if len(parts) != 2 or parts[0] not in SOUND_FOLDERS or \
+       parts[1].startswith(".") or os.sep in parts[1]:
+      return None
+    content_type = mimetypes.guess_type(parts[1])[0]
+    if content_type is None or not content_type.startswith("audio/"):
+      return None
+    return os.path.join(self.server.root, parts[0], parts[1])
+
+  def send_empty(self, code):
+    self.send_response(code)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def serve(self, send_body):
+    path = self.translate_path()
+    if path is None or not os.path.isfile(path):
+      self.send_empty(404)
+      return
+
+    try:
+      f = open(path, "rb")
+    except IOError:
+      self.send_empty(404)
+      return
+
+    with f:
+      st = os.fstat(f.fileno())
+      size = st.st_size
+      etag = '"%x-%x"' % (int(st.st_mtime), size)
+
+      if self.not_modified(etag, st.st_mtime):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return
+
+      byte_range = parse_range(self.headers.getheader("range"), size)
+      if byte_range is False:
+        self.send_response(416)
+        self.send_header("Content-Range", "bytes */%s" % size)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+
+      if byte_range is None:
+        start, end = 0, size - 1
+        self.send_response(200)
+      else:
+        start, end = byte_range
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, size))
+      length = max(0, end - start + 1)
+
+      content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(length))
+      self.send_header("Accept-Ranges", "bytes")
+      self.send_header("ETag", etag)
+      self.send_header("Last-Modified", formatdate(st.st_mtime, usegmt=True))
+      self.send_header("Cache-Control", "max-age=%s" % self.server.max_age)
+      self.end_headers()
+
+      if send_body and length:
+        self.wfile.flush()
+        self.send_file(f, start, length)
+
+  def not_modified(self, etag, mtime):
+    if_none_match = self.headers.getheader("if-none-match")
+    if if_none_match:
+      return etag in [tag.strip() for tag in if_none_match.split(",")] or \
+             if_none_match.strip() == "*"
+    if_modified_since = self.headers.getheader("if-modified-since")
+    if if_modified_since:
+      date = parsedate_tz(if_modified_since)
+      if date is not None:
+        return int(mtime) <= mktime_tz(date)
+    return False
+
+  def send_file(self, f, start, length):
+    """ Send length bytes from start, straight from a memory map of the file.
+      Python 2 has no sendfile(), the map avoids copying the file content
+      into Python strings.
+    """
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      offset = start
+      end = start + length
+      while offset < end:
+        chunk = min(CHUNK_SIZE, end - offset)
+        self.connection.sendall(buffer(mm, offset, chunk))
+        offset += chunk
+    except socket.error:
+      # The client went away, e.g. a speaker skipping to another range.
+      self.close_connection = 1
+    finally:
+      mm.close()
+
+  def log_message(self, format, *args):
+    logging.getLogger(__name__).debug("%s - %s" % (self.address_string(),
+                                                   format % args))
+
+class SoundServer(ThreadingMixIn, HTTPServer):
+  """ HTTP server the speakers fetch the bell sounds from.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, root, port, address="", max_age=3600, logger=None):
+    """
+    Args:
+      root (str): served folder, e.g. SoundsManager.sounds_folder.
+      port (int): TCP port.
+      max_age (int): Cache-Control max-age, in seconds.
+    """
+    self.logger = logger or logging.getLogger(__name__)
+    self.root = os.path.abspath(root)
+    self.max_age = max_age
+    HTTPServer.__init__(self, (address, port), SoundRequestHandler)
+
+  def start(self):
+    """ Serve in a daemon thread.
+    """
+    thread = threading.Thread(target=self.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.logger.info("Serving %s on port %s." % (self.root,
+                                                 self.server_address[1]))
+    return thread
+
+def sound_uri(base_uri, sound_path):
+  """ Return the URI of a sound file, from the base URI of the sounds folder.
+  Args:
+    base_uri (str): e.g. "http://192.168.0.231:8080/"
+    sound_path (str): full path of the sound file.
+  """
+  split = os.path.split(sound_path)
+  relative = os.path.join(os.path.split(split[0])[1], split[1])
+  return base_uri + urllib.quote(relative)
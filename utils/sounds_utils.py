@@ -4,13 +4,88 @@
 # See the file COPYING for details.
 
 import os
+import json
+import hashlib
+import time
 from glob import glob
 import shutil
+import tempfile
+import threading
+
+import pyinotify
 
 from settings import *
+from file_utils import temp_path, write_file
+from mp3_info import mp3_info, id3v2_size, find_first_frame, PROBE_SIZE
 
 import logging
 
+class SoundsEventHandler(pyinotify.ProcessEvent):
+  """ Keeps the sounds index of a SoundsManager in sync with the folders.
+  """
+  def __init__(self, soundsManagerInstance):
+    super(SoundsEventHandler, self).__init__()
+    self.soundsManagerInstance = soundsManagerInstance
+
+  def process_IN_CREATE(self, event):
+    self.soundsManagerInstance.index_add(event.pathname)
+
+  def process_IN_CLOSE_WRITE(self, event):
+    self.soundsManagerInstance.index_add(event.pathname)
+
+  def process_IN_MOVED_TO(self, event):
+    self.soundsManagerInstance.index_add(event.pathname)
+
+  def process_IN_DELETE(self, event):
+    self.soundsManagerInstance.index_remove(event.pathname)
+
+  def process_IN_MOVED_FROM(self, event):
+    self.soundsManagerInstance.index_remove(event.pathname)
+
+class UploadFile(object):
+  """ File an uploaded sound is streamed to.
+
+    Data is written as it arrives to a hidden temporary file in the uploads
+    folder, and hashed on the way. The first PROBE_SIZE bytes are checked
+    for an MP3 header, the rest of an invalid upload is not written.
+    SoundsManager.commit_upload() then renames the file into its slot.
+  """
+  def __init__(self, folder):
+    self.file = tempfile.NamedTemporaryFile(dir=folder, prefix=".upload-",
+                                            suffix=".tmp", delete=False)
+    self.name = self.file.name
+    self.sha1 = hashlib.sha1()
+    self.size = 0
+    self.head = ""
+    self.valid = None               # None until enough data is checked
+
+  def write(self, data):
+    if self.valid is False:
+      return
+    self.sha1.update(data)
+    self.size += len(data)
+    if self.valid is None:
+      self.head += data[:PROBE_SIZE - len(self.head)]
+      if len(self.head) >= PROBE_SIZE:
+        self.check_head()
+    if self.valid is not False:
+      self.file.write(data)
+
+  def check_head(self):
+    """ Tell if the beginning of the file looks like an MP3 file.
+    """
+    if self.valid is None:
+      # A large ID3 tag may hide the first frame, mp3_info() decides then.
+      self.valid = id3v2_size(self.head) > len(self.head) - 4 or \
+                   find_first_frame(self.head, id3v2_size(self.head))[1] \
+                   is not None
+      self.head = ""
+    return self.valid
+
+  def __getattr__(self, name):
+    # seek, tell, read, ... as used by the form parser.
+    return getattr(self.file, name)
+
 class SoundsManager():
   """ This class handles the sounds that are used as a bell sound.
 
@@ -25,6 +100,13 @@ class SoundsManager():
     and read/write permission for uploads.
 
     Sounds' filenames always start with "index-", in the form index-name.ext
+
+    Duration and format of each sound are parsed once and kept in
+    sounds/metadata.json, entries are refreshed when size or mtime change.
+
+    Paths are looked up by index in memory. The index is built once and kept
+    up to date with inotify, so changes made by the other process (engine or
+    webfrontend) are seen too.
   """
   def __init__(self, config_subdir, logger=None):
     self.logger = logger or logging.getLogger(__name__)
@@ -47,27 +129,199 @@ class SoundsManager():
                           exc_info=True)
 
     try:
-      # Copy default sounds to default folder
+      # Sync default sounds to default folder
       package_folder = path = os.path.dirname(__file__)
 
       sounds_defaults = os.path.join(package_folder, "..", "sounds", "defaults")
-      for filename in glob(os.path.join(sounds_defaults, '*-*')):
-        shutil.copy(filename, self.sounds_defaults_folder)
+      self.sync_defaults(sounds_defaults)
     except:
       self.logger.error("Could not copy default sounds to user config folder.",
                         exc_info=True)
 
+    # Remove the uploads left over by an interrupted request.
+    for filename in glob(os.path.join(self.sounds_uploads_folder,
+                                      ".upload-*.tmp")):
+      try:
+        os.remove(filename)
+      except:
+        self.logger.error("While deleting %s." % filename, exc_info=True)
+
+    self.metadata_filename = os.path.join(self.sounds_folder, "metadata.json")
+    self.metadata_lock = threading.Lock()
+    self.metadata = {}
+    self.index_metadata()
+
+    # {folder: {index: [path, ...]}}
+    self.index_lock = threading.Lock()
+    self.index = {}
+    self.listeners = []
+
+    # Start watching before the first scan, not to miss any change.
+    try:
+      self.wm = pyinotify.WatchManager()
+      mask = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | \
+             pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE | \
+             pyinotify.IN_MOVED_FROM
+      self.notifier = pyinotify.ThreadedNotifier(self.wm,
+                                                 SoundsEventHandler(self))
+      self.notifier.setDaemon(True)
+      self.notifier.start()
+      self.wdd = self.wm.add_watch([self.sounds_defaults_folder,
+                                    self.sounds_uploads_folder], mask)
+    except:
+      self.logger.error("Could not start observe on %s" % self.sounds_folder,
+                        exc_info=True)
+    self.build_index()
+
+  def sync_defaults(self, source_folder):
+    """ Bring the default sounds up to date with the ones of the package.
+
+      A manifest (defaults/.manifest.json) records size, mtime and sha1 of
+      each synced file, so unchanged sounds are skipped without being read.
+      Changed sounds are hard-linked when possible, copied otherwise, and
+      replaced atomically.
+    Args:
+      source_folder (str): the sounds/defaults folder of the package.
+    """
+    start = time.time()
+    manifest_filename = os.path.join(self.sounds_defaults_folder,
+                                     ".manifest.json")
+    try:
+      with open(manifest_filename) as f:
+        manifest = json.load(f)
+    except IOError:
+      manifest = {}
+    except:
+      self.logger.error("Could not read %s." % manifest_filename,
+                        exc_info=True)
+      manifest = {}
+
+    def sha1(path):
+      h = hashlib.sha1()
+      with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), ""):
+          h.update(chunk)
+      return h.hexdigest()
+
+    copied = 0
+    new_manifest = {}
+    for source in glob(os.path.join(source_folder, "*-*")):
+      filename = os.path.basename(source)
+      target = os.path.join(self.sounds_defaults_folder, filename)
+      st = os.stat(source)
+      entry = manifest.get(filename)
+      try:
+        target_size = os.path.getsize(target)
+      except OSError:
+        target_size = None
+
+      if entry and entry["size"] == st.st_size and \
+         entry["mtime"] == st.st_mtime and target_size == st.st_size:
+        new_manifest[filename] = entry
+        continue
+
+      entry = {"size": st.st_size, "mtime": st.st_mtime, "sha1": sha1(source)}
+      if target_size != st.st_size or sha1(target) != entry["sha1"]:
+        # A unique name, the link needs it not to exist.
+        tmp_target = temp_path(target)
+        os.remove(tmp_target)
+        try:
+          os.link(source, tmp_target)
+        except OSError:
+          shutil.copy2(source, tmp_target)
+        os.rename(tmp_target, target)
+        copied += 1
+      new_manifest[filename] = entry
+
+    if new_manifest != manifest:
+      write_file(manifest_filename,
+                 json.dumps(new_manifest, indent=2, sort_keys=True))
+
+    self.logger.info("Synced default sounds in %.3fs : %s updated, %s total." %
+                     (time.time() - start, copied, len(new_manifest)))
+
+  def build_index(self):
+    """ Scan the sounds folders and replace the index.
+    """
+    index = {}
+    for folder in (self.sounds_defaults_folder, self.sounds_uploads_folder):
+      index[folder] = {}
+      for path in sorted(glob(os.path.join(folder, "*-*"))):
+        slot = self.parse_index(path)
+        if slot is not None:
+          index[folder].setdefault(slot, []).append(path)
+    with self.index_lock:
+      self.index = index
+    self.notify_listeners()
+
+  def add_listener(self, listener):
+    """ Call listener(soundsManager) each time the sounds index changes.
+    """
+    self.listeners.append(listener)
+
+  def notify_listeners(self):
+    for listener in self.listeners:
+      try:
+        listener(self)
+      except:
+        self.logger.error("In sounds listener %s." % listener, exc_info=True)
+
+  def parse_index(self, path):
+    """ Return the index of a sound from its path, None if it has none.
+    """
+    filename = os.path.basename(path)
+    # Hidden files are temporary files, e.g. an upload in progress.
+    if filename.startswith("."):
+      return None
+    try:
+      return int(filename.split("-", 1)[0])
+    except ValueError:
+      return None
+
+  def index_add(self, path):
+    folder = os.path.dirname(path)
+    slot = self.parse_index(path)
+    if slot is None:
+      return
+    with self.index_lock:
+      paths = self.index.setdefault(folder, {}).setdefault(slot, [])
+      if path not in paths:
+        paths.append(path)
+        paths.sort()
+    # Also on rewrites of an indexed path, its metadata may have changed.
+    self.notify_listeners()
+
+  def index_remove(self, path):
+    folder = os.path.dirname(path)
+    slot = self.parse_index(path)
+    if slot is None:
+      return
+    with self.index_lock:
+      paths = self.index.get(folder, {}).get(slot, [])
+      if path not in paths:
+        return
+      paths.remove(path)
+      if not paths:
+        self.index.get(folder, {}).pop(slot, None)
+    self.notify_listeners()
+
   def delete_file_by_index(self, index):
     """ Delete an uploaded sound from its index.
     Args:
       index (int): index of the uploaded sound to delete.
     """
-    target = os.path.join(self.sounds_uploads_folder, str(index)) + "-*"
-    for file_to_delete in glob(target):
+    with self.index_lock:
+      files_to_delete = list(self.index.get(self.sounds_uploads_folder,
+                                            {}).get(index, []))
+    for file_to_delete in files_to_delete:
       try:
         os.remove(file_to_delete)
+      except OSError:
+        pass                        # already gone
       except:
         self.logger.error("While deleting %s." % file_to_delete, exc_info=True)
+      # Do not wait for inotify, the caller may look the slot up right away.
+      self.index_remove(file_to_delete)
 
   def create_upload_path(self, index, filename):
     """ Return the full path of an uploading sound from it's name and index.
@@ -80,6 +334,56 @@ class SoundsManager():
     full_filename = "%s-%s" % (str(index), filename)
     return os.path.join(self.sounds_uploads_folder, full_filename)
 
+  def create_upload_file(self):
+    """ Return an UploadFile to stream an uploaded sound to.
+    """
+    return UploadFile(self.sounds_uploads_folder)
+
+  def commit_upload(self, upload, index, filename):
+    """ Move a complete upload into its slot, replacing the previous sound.
+    Args:
+      upload (UploadFile): the uploaded sound.
+      index (int): index of the uploaded sound.
+      filename (str): filename of the uploaded sound.
+    Returns:
+      full_path (str) : full path of the sound. None if it is not a valid
+                        MP3 file.
+    """
+    upload.file.close()
+    if not upload.check_head() or mp3_info(upload.name) is None:
+      self.logger.error("Upload %s is not an MP3 file." % filename)
+      self.discard_upload(upload)
+      return None
+
+    path = self.create_upload_path(index, filename)
+    os.rename(upload.name, path)
+    self.index_add(path)
+    # The slot always holds a sound, the previous one is removed afterwards.
+    with self.index_lock:
+      previous = [p for p in self.index.get(self.sounds_uploads_folder,
+                                            {}).get(index, []) if p != path]
+    for file_to_delete in previous:
+      try:
+        os.remove(file_to_delete)
+      except OSError:
+        pass
+      self.index_remove(file_to_delete)
+    self.logger.info("Uploaded %s : %s bytes, sha1 %s." %
+                     (path, upload.size, upload.sha1.hexdigest()))
+    return path
+
+  def discard_upload(self, upload):
+    """ Remove the temporary file of an upload that was not committed.
+    """
+    if not isinstance(upload, UploadFile):
+      return
+    try:
+      upload.file.close()
+      if os.path.exists(upload.name):
+        os.remove(upload.name)
+    except:
+      self.logger.error("While deleting %s." % upload.name, exc_info=True)
+
   def search_path_by_index(self, index, default_sound=False):
     """ Return the full path of a sound by index, uploads are searched first.
     Args:
@@ -87,13 +391,92 @@ class SoundsManager():
     Returns:
       full_path (str) : full path of the sound. None if nothing is found.
     """
-    if not default_sound:
-      uploads = glob(os.path.join(self.sounds_uploads_folder, str(index)) + "-*")
-      if uploads:
-        return uploads[0]
+    with self.index_lock:
+      if not default_sound:
+        uploads = self.index.get(self.sounds_uploads_folder, {}).get(index)
+        if uploads:
+          return uploads[0]
 
-    defaults = glob(os.path.join(self.sounds_defaults_folder, str(index)) + "-*")
-    if defaults:
-      return defaults[0]
+      defaults = self.index.get(self.sounds_defaults_folder, {}).get(index)
+      if defaults:
+        return defaults[0]
 
     return None
+
+  def index_metadata(self):
+    """ Load the metadata index, parse new or changed sounds and drop the
+        entries of deleted ones.
+    """
+    try:
+      with open(self.metadata_filename) as f:
+        self.metadata = json.load(f)
+    except IOError:
+      self.metadata = {}
+    except:
+      self.logger.error("Could not read %s." % self.metadata_filename,
+                        exc_info=True)
+      self.metadata = {}
+
+    paths = glob(os.path.join(self.sounds_defaults_folder, "*-*")) + \
+            glob(os.path.join(self.sounds_uploads_folder, "*-*"))
+    keys = [os.path.relpath(path, self.sounds_folder) for path in paths]
+    changed = False
+    for key in list(self.metadata.keys()):
+      if key not in keys:
+        del self.metadata[key]
+        changed = True
+    for path in paths:
+      changed = self.update_metadata(path) or changed
+    if changed:
+      self.save_metadata()
+
+  def update_metadata(self, path):
+    """ Parse a sound if it is not indexed or changed since.
+    Returns:
+      True if the index was modified.
+    """
+    key = os.path.relpath(path, self.sounds_folder)
+    try:
+      st = os.stat(path)
+    except OSError:
+      with self.metadata_lock:
+        return self.metadata.pop(key, None) is not None
+
+    with self.metadata_lock:
+      entry = self.metadata.get(key)
+    if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+      return False
+
+    try:
+      info = mp3_info(path) or {}
+    except:
+      self.logger.error("Could not parse %s." % path, exc_info=True)
+      info = {}
+    info["size"] = st.st_size
+    info["mtime"] = st.st_mtime
+    with self.metadata_lock:
+      self.metadata[key] = info
+    self.logger.info("Indexed %s : %s" % (key, info))
+    return True
+
+  def save_metadata(self):
+    with self.metadata_lock:
+      data = json.dumps(self.metadata, indent=2, sort_keys=True)
+    try:
+      write_file(self.metadata_filename, data)
+    except:
+      self.logger.error("Could not write %s." % self.metadata_filename,
+                        exc_info=True)
+
+  def get_metadata(self, path):
+    """ Return the metadata of a sound, parsing it if needed.
+    Args:
+      path (str): full path of the sound.
+    Returns:
+      {"duration": seconds, "bitrate": kbps, "format": ..., ...}, {} if the
+      sound is unknown or could not be parsed.
+    """
+    if self.update_metadata(path):
+      self.save_metadata()
+    with self.metadata_lock:
+      return self.metadata.get(os.path.relpath(path, self.sounds_folder), {})
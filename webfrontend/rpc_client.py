@@ -0,0 +1,62 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import json
+import threading
+
+import rpyc
+
+import logging
+
+class RPCClient():
+  """ Persistent connection to the engine RPC server.
+
+    The connection is opened on first use and kept for the next requests,
+    it is opened again after an error. Calls on one client run one at a
+    time, use one client per caller that must not wait for the others.
+  """
+  def __init__(self, host, port, logger=None):
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.host = host
+    self.port = port
+    self.conn = None
+    self.lock = threading.Lock()
+
+  def call(self, name, *args):
+    """ Call an exposed function of the engine.
+    Args:
+      name (str): function name, without the "exposed_" prefix.
+    """
+    with self.lock:
+      for attempt in range(2):
+        if self.conn is None or self.conn.closed:
+          self.conn = rpyc.connect(self.host, self.port)
+        try:
+          return getattr(self.conn.root, name)(*args)
+        except (EOFError, IOError):
+          # The engine was restarted, retry once on a new connection.
+          self.close()
+          if attempt:
+            raise
+
+  def close(self):
+    try:
+      if self.conn is not None:
+        self.conn.close()
+    except:
+      pass
+    self.conn = None
+
+  def get_status(self):
+    """ Return the engine status, decoded, in one round trip.
+    """
+    return json.loads(self.call("get_status"))
+
+  def start_discovery(self):
+    return json.loads(self.call("start_discovery"))
+
+  def get_discovery_status(self):
+    return json.loads(self.call("get_discovery_status"))
@@ -0,0 +1,76 @@
+# Lextend
+# Copyright (c) 2014-2015 Egger Enertech <http://www.egger-enertech.ch>
+# Released under the GNU Public License 3 (or higher, your choice)
+# See the file COPYING for details.
+
+import time
+import threading
+
+import logging
+
+class StatusCache():
+  """ Engine status, fetched when a page asks for it.
+
+    get() returns the last fetched status at once, and fetches it again in a
+    background thread once it is older than ttl, so nothing is fetched while
+    no page is viewed. Only a get() with no status yet waits for the fetch,
+    up to first_wait seconds. When a fetch fails the previous status is
+    kept, along with the time it was fetched.
+  """
+  def __init__(self, fetch, ttl=10, first_wait=5, logger=None):
+    """
+    Args:
+      fetch (callable): returns the status, e.g. RPCClient.get_status.
+      ttl (float): seconds a status is served before it is fetched again.
+      first_wait (float): seconds to wait for a status when there is none.
+    """
+    self.logger = logger or logging.getLogger(__name__)
+
+    self.fetch = fetch
+    self.ttl = ttl
+    self.first_wait = first_wait
+    self.status = None
+    self.updated = None             # time of the last successful fetch
+    self.fetched = None             # time of the last fetch attempt
+    self.error = False              # True if the last fetch failed
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def refresh(self):
+    try:
+      status = self.fetch()
+      self.status, self.updated, self.error = status, time.time(), False
+    except:
+      self.error = True
+      self.logger.error("Could not refresh the engine status.", exc_info=True)
+
+  def start_refresh(self):
+    """ Fetch the status in a background thread, unless one is running.
+    Returns:
+      the fetching thread.
+    """
+    with self.lock:
+      if self.thread is None or not self.thread.is_alive():
+        self.fetched = time.time()
+        self.thread = threading.Thread(target=self.refresh)
+        self.thread.setDaemon(True)
+        self.thread.start()
+      return self.thread
+
+  def invalidate(self):
+    """ Fetch the status again without waiting for the ttl.
+    """
+    self.start_refresh()
+
+  def get(self):
+    """ Return (status, updated, stale).
+      status is None until the first successful fetch.
+    """
+    if self.fetched is None or time.time() - self.fetched > self.ttl:
+      thread = self.start_refresh()
+      if self.status is None:
+        thread.join(self.first_wait)
+    status, updated = self.status, self.updated
+    stale = self.error or updated is None or \
+            time.time() - updated > 2 * self.ttl
+    return status, updated, stale